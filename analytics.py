@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+
+from archive import ARCHIVE_STATUSES
+from sheet_cache import to_category
+
+
+# 旅行横断の分析。型変換済みの支出 (SheetCache の expenses) と旅行一覧から、
+# 旅行毎のループを使わず groupby の列演算だけで集計する。
+
+def combine_ledgers(frames):
+    # ホットシートと各アーカイブパーティションの支出を 1 つの台帳にする。
+    # アーカイブ処理の途中 (コピー済み・削除前) の行が両方にあっても 1 件として数える
+    filled = [df for df in frames if not df.empty]
+    if len(filled) <= 1:
+        return filled[0] if filled else frames[0]
+    ledger = pd.concat(filled, ignore_index=True).drop_duplicates("entry_id")
+    # シート毎にカテゴリ型の値集合が違うと concat で文字列列に戻るため揃え直す
+    return ledger.assign(category=to_category(ledger["category"]))
+
+
+def trip_schedule(df_trips):
+    # 旅行毎の期間と予算。日付が不正な旅行の予算線は NaN になる
+    trips = df_trips.drop_duplicates("trip_id", keep="last").set_index("trip_id")
+    start = pd.to_datetime(trips["start_date"], errors="coerce", format="mixed").dt.normalize()
+    end = pd.to_datetime(trips["end_date"], errors="coerce", format="mixed").dt.normalize()
+    days = (end - start).dt.days + 1
+    return pd.DataFrame({
+        "trip_name": trips["trip_name"], "status": trips["status"], "budget": trips["total_budget"],
+        "start": start, "end": end, "days": days.where(days > 0),
+    })
+
+
+def daily_spend(df_ex, schedule):
+    # 旅行 × 日の支出、累計、予算線 (開始日 0 円から終了日に総予算へ至る直線) 上の計画累計
+    dated = df_ex[df_ex["expense_date"].notna()]
+    daily = dated.groupby(["trip_id", "expense_date"], sort=True)["amount"].sum().rename("spent").reset_index()
+    daily["cumulative"] = daily.groupby("trip_id")["spent"].cumsum()
+    info = schedule.reindex(daily["trip_id"])
+    elapsed = (daily["expense_date"].to_numpy() - info["start"].to_numpy()) / np.timedelta64(1, "D") + 1
+    share = np.clip(elapsed, 0, info["days"].to_numpy()) / info["days"].to_numpy()
+    daily["planned"] = info["budget"].to_numpy() * share
+    return daily
+
+
+def trip_summary(df_ex, schedule, as_of):
+    # 旅行毎の合計・浪費率・満足度あたりの金額・予算超過見込み
+    rated = df_ex["satisfaction"] > 0
+    grouped = df_ex.assign(
+        _waste=df_ex["amount"].where(df_ex["is_waste"], 0),
+        _rated_amount=df_ex["amount"].where(rated, 0),
+        _rated_sat=df_ex["satisfaction"].where(rated, 0),
+    ).groupby("trip_id").agg(
+        spent=("amount", "sum"), waste=("_waste", "sum"), count=("amount", "size"),
+        rated_amount=("_rated_amount", "sum"), rated_sat=("_rated_sat", "sum"),
+    )
+    summary = schedule.join(grouped, how="left")
+    summary[["spent", "waste", "count", "rated_amount", "rated_sat"]] = (
+        summary[["spent", "waste", "count", "rated_amount", "rated_sat"]].fillna(0).astype("int64"))
+
+    # 消化ペース: 基準日までの経過日数あたりの支出を期間全体へ延長する。
+    # 終了済み (期間経過・完了・中止) の旅行は実績がそのまま着地額になり、開始前の旅行は見込みを出さない
+    as_of = pd.Timestamp(as_of).normalize()
+    elapsed = ((as_of - summary["start"]).dt.days + 1).where(lambda d: d >= 1)
+    finished = (elapsed >= summary["days"]) | summary["status"].isin(ARCHIVE_STATUSES)
+    elapsed = elapsed.mask(finished, summary["days"])
+    summary["burn_rate"] = summary["spent"] / elapsed
+    summary["projected"] = summary["burn_rate"] * summary["days"]
+    summary["overrun"] = summary["projected"] - summary["budget"]
+    summary["waste_ratio"] = summary["waste"] / summary["spent"].where(summary["spent"] > 0)
+    # 評価済みの支出 1,000 円あたりの満足度合計 (未評価の支出は分母に含めない)
+    summary["satisfaction_per_1k"] = summary["rated_sat"] * 1000 / summary["rated_amount"].where(summary["rated_amount"] > 0)
+    return summary
+
+
+def category_mix(df_ex):
+    # 旅行毎のカテゴリ構成比 (行: trip_id, 列: カテゴリ)
+    amounts = df_ex.pivot_table(index="trip_id", columns="category", values="amount", aggfunc="sum", fill_value=0, observed=False)
+    amounts.columns = amounts.columns.astype(str)
+    totals = amounts.sum(axis=1)
+    return amounts.div(totals.where(totals > 0), axis=0).fillna(0)
+
+
+def compute(df_ex, df_trips, as_of):
+    schedule = trip_schedule(df_trips)
+    df_ex = df_ex[df_ex["trip_id"].isin(schedule.index)]
+    return {
+        "daily": daily_spend(df_ex, schedule),
+        "summary": trip_summary(df_ex, schedule, as_of),
+        "mix": category_mix(df_ex),
+    }
@@ -0,0 +1,127 @@
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+import gspread
+
+from metrics import METRICS
+
+# --- 設定 ---
+SHEETS_QUOTA_PER_MINUTE = 60   # Sheets API の 1 ユーザーあたり読み書き上限 (リクエスト/分)
+BURST = 10
+MAX_RETRIES = 5
+BASE_DELAY = 1.0
+MAX_DELAY = 32.0
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+# プロセス全体で共有するトークンバケット。per_minute が 0 / None なら無制限。
+class TokenBucket:
+    def __init__(self, per_minute, burst=BURST):
+        self.rate = per_minute / 60.0 if per_minute else 0.0
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # トークンが得られるまで待ち、待機秒数を返す
+        if not self.rate:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def error_status(e):
+    code = getattr(e, "code", None)
+    if isinstance(code, int):
+        return code
+    return getattr(getattr(e, "response", None), "status_code", None)
+
+
+def retry_after(e):
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+# Sheets API 呼び出しの共通窓口。
+# - トークンバケットでクォータ内に流量を制限する
+# - 429 / 5xx はジッター付き指数バックオフで再試行し、Retry-After があればそれに従う
+# - 同一キーの読み取りが同時に走った場合は 1 回の呼び出しにまとめる
+class QuotaClient:
+    def __init__(self, per_minute=SHEETS_QUOTA_PER_MINUTE, burst=BURST, max_retries=MAX_RETRIES,
+                 base_delay=BASE_DELAY, max_delay=MAX_DELAY, sleep=time.sleep):
+        self.bucket = TokenBucket(per_minute, burst)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.counters = {"calls": 0, "retries": 0, "throttle_wait": 0.0, "backoff_wait": 0.0, "coalesced": 0, "errors": 0}
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def call(self, func, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self._count("throttle_wait", self.bucket.acquire())
+            self._count("calls")
+            try:
+                # 再試行を含めず 1 回の API 呼び出し毎の所要時間を記録する
+                with METRICS.timer(f"api.{getattr(func, '__name__', 'call')}"):
+                    return func(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                status = error_status(e)
+                if status not in RETRYABLE_STATUS or attempt == self.max_retries:
+                    self._count("errors")
+                    raise
+                delay = retry_after(e)
+                if delay is None:
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                    if status == 429:
+                        # クォータ超過時は少なくとも次のトークン補充分は待つ
+                        delay = max(delay, self.base_delay)
+                self._count("retries")
+                self._count("backoff_wait", delay)
+                self.sleep(delay)
+
+    def read(self, key, func, *args, **kwargs):
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+            else:
+                self.counters["coalesced"] += 1
+        if not owner:
+            return future.result()
+        try:
+            result = self.call(func, *args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
@@ -0,0 +1,54 @@
+import re
+from datetime import datetime
+
+from storage import HEADERS, MANIFEST_SHEET, StorageError, partition_name
+
+# この状態の旅行は支出をアーカイブパーティションへ移し、ホットな expenses シートから外す
+ARCHIVE_STATUSES = {"Completed", "Cancelled"}
+
+
+def partition_for(trip):
+    # 終了日 (無ければ開始日) の年でパーティションを決める
+    for col in ("end_date", "start_date"):
+        m = re.match(r"^(\d{4})", str(trip.get(col, "")))
+        if m:
+            return partition_name(m.group(1))
+    return partition_name(datetime.now().year)
+
+
+def _copy_trip(backend, trip_id, src, dst):
+    # dst にまだ無い行だけを追記し、dst 上の件数と追記件数を返す。
+    # 書き込みキューは at-least-once のため、途中で失敗しても再実行で重複しない
+    records = backend.read_trip(trip_id, src)
+    copied = {str(r["entry_id"]) for r in backend.read_trip(trip_id, dst)}
+    header = HEADERS["expenses"]
+    missing = [[r.get(c, "") for c in header] for r in records if str(r["entry_id"]) not in copied]
+    backend.append_rows(dst, missing)
+    return len(copied) + len(missing), len(missing)
+
+
+# コピー → manifest 記録 → 元シートから削除 の順に行う。どの時点で止まっても
+# manifest が指す場所に全行が揃っているため、読み取り側は不整合を見ない。
+def archive_trip(backend, trip_id, partition, archived_at):
+    trip_id = str(trip_id)
+    total, _ = _copy_trip(backend, trip_id, "expenses", partition)
+    values = {"partition": partition, "archived_at": archived_at, "row_count": total}
+    manifest = {str(r["trip_id"]) for r in backend.read_records(MANIFEST_SHEET)}
+    if trip_id in manifest:
+        backend.update_row(MANIFEST_SHEET, trip_id, values)
+    else:
+        backend.append_rows(MANIFEST_SHEET, [[trip_id, partition, archived_at, total]])
+    # ホットシートから外した件数を返す
+    return backend.delete_where("expenses", "trip_id", trip_id)
+
+
+def restore_trip(backend, trip_id, partition):
+    # 旅行を進行中に戻した場合はホットシートへ戻す
+    trip_id = str(trip_id)
+    _, restored = _copy_trip(backend, trip_id, partition, "expenses")
+    try:
+        backend.delete_row(MANIFEST_SHEET, trip_id)
+    except StorageError:
+        pass
+    backend.delete_where(partition, "trip_id", trip_id)
+    return restored
@@ -0,0 +1,299 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date
+
+import numpy as np
+
+import storage
+from api_client import QuotaClient
+from rollups import RollupStore
+from sheet_cache import SheetCache
+
+# --- 設定 ---
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+ROWS_PER_TRIP = 500
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baselines.json")
+WALL_TOLERANCE = 0.5     # ベースライン比 +50% 以上で劣化とみなす (実時間は揺れが大きいため緩め)
+MEMORY_TOLERANCE = 0.2
+APP_TIMEOUT = 600
+
+# 使い方:
+#   python bench.py                          # 既定サイズで計測し、ベースラインと比較
+#   python bench.py --sizes 1000000 --latency 0.05 --error-rate 0.02
+#   python bench.py --save-baseline          # 現在の結果をベースラインとして保存
+# API 呼び出し数は決定的なので増えたら劣化、実時間・ピークメモリは許容幅を超えたら劣化として報告する。
+
+
+# --- 合成データ ---
+
+def synthetic_ledger(n_rows, seed=0):
+    # n_rows 件の支出と、ROWS_PER_TRIP 件毎に 1 件の旅行を作る (行は HEADERS 順のリスト)
+    rng = np.random.default_rng(seed)
+    n_trips = max(1, n_rows // ROWS_PER_TRIP)
+    statuses = ["Active", "Planning", "Completed", "Cancelled"]
+    trips = [
+        [f"t{i}", f"旅行{i}", f"{2020 + i % 5}-0{1 + i % 9}-01", f"{2020 + i % 5}-0{1 + i % 9}-07",
+         statuses[i % len(statuses)], 100_000 + 1_000 * (i % 50), ""]
+        for i in range(n_trips)
+    ]
+    trip_idx = rng.integers(0, n_trips, n_rows)
+    days = rng.integers(1, 8, n_rows)
+    categories = np.array(storage.CATEGORIES)[rng.integers(0, len(storage.CATEGORIES), n_rows)]
+    amounts = rng.integers(1, 500, n_rows) * 100
+    sats = rng.integers(0, 11, n_rows)
+    blank_date = rng.random(n_rows) < 0.1
+    waste = np.where(rng.random(n_rows) < 0.15, "TRUE", "FALSE")
+    expenses = []
+    for i in range(n_rows):
+        start = trips[trip_idx[i]][2]
+        day = f"{start[:8]}{days[i]:02d}"
+        expenses.append([
+            f"e{i}", f"t{trip_idx[i]}", f"{day} 12:00:00", str(categories[i]), f"item{i % 997}",
+            int(amounts[i]), int(sats[i]), "", "" if blank_date[i] else day, str(waste[i]),
+        ])
+    return trips, expenses
+
+
+def seed_backend(backend, n_rows, seed=0):
+    # Fake スプレッドシートに API 呼び出しとして数えずに投入する (既に投入済みなら何もしない)
+    sp = backend.spreadsheet
+    if len(sp.worksheet("expenses")._rows) > 1:
+        return
+    trips, expenses = synthetic_ledger(n_rows, seed)
+    sp.seed_rows("trips", trips)
+    sp.seed_rows("expenses", expenses)
+
+
+# --- 計測 ---
+
+class Measurement:
+    def __init__(self, name, rows, spreadsheet, client, memory=True):
+        self.name = name
+        self.rows = rows
+        self.spreadsheet = spreadsheet
+        self.client = client
+        self.memory = memory
+
+    def __enter__(self):
+        self.calls = self.spreadsheet.total_calls
+        self.retries = self.client.stats()["retries"]
+        if self.memory:
+            tracemalloc.start()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.started
+        peak = tracemalloc.get_traced_memory()[1] if self.memory else 0
+        if self.memory:
+            tracemalloc.stop()
+        self.result = {
+            "wall": round(wall, 4),
+            "api_calls": self.spreadsheet.total_calls - self.calls,
+            "retries": self.client.stats()["retries"] - self.retries,
+            "peak_mb": round(peak / 1024 ** 2, 2),
+        }
+        return False
+
+
+def bench_backend(n_rows, args, results):
+    # ストレージ・キャッシュ・集計・監査ロジック単体 (Streamlit なし)
+    from tabs.audit import DISPLAY_COLS, filter_ledger, ledger_page, style_audit_rows
+
+    sp = storage.FakeSpreadsheet(seed=args.seed)
+    client = QuotaClient(per_minute=0, base_delay=args.backoff, max_delay=args.backoff * 8)
+    backend = storage.SheetsBackend(sp, client)
+    seed_backend(backend, n_rows, args.seed)
+    sp.set_faults(args.latency, args.error_rate)
+
+    def measure(name):
+        m = Measurement(name, n_rows, sp, client, memory=not args.no_memory)
+        results.append(m)
+        return m
+
+    cache = SheetCache("expenses", storage.HEADERS["expenses"])
+    read_all = lambda: backend.read_records("expenses")
+    read_tail = lambda offset: backend.read_tail("expenses", offset)
+    with measure("cache_cold"):
+        df = cache.get(read_all, read_tail)
+    with measure("cache_warm"):
+        cache.get(read_all, read_tail)
+    # 他セッションの追記を末尾差分で取り込む
+    backend.append_rows("expenses", [[f"x{i}", "t0", "2024-01-01 12:00:00", "食事", "x", 100, 5, "", "2024-01-01", "FALSE"] for i in range(100)])
+    cache.checked_at = 0.0
+    with measure("cache_delta_100"):
+        df = cache.get(read_all, read_tail)
+    with measure("rollups_reset"):
+        RollupStore().reset(df)
+    with measure("read_trip"):
+        backend.read_trip("t1")
+    with measure("update_row_x20"):
+        for i in range(0, n_rows, max(1, n_rows // 20)):
+            backend.update_row("expenses", f"e{i}", {"amount": 1234, "satisfaction": 7})
+    with measure("audit_filter_page"):
+        filtered = filter_ledger(df, ["食事", "交通"], "浪費のみ", None, (1, 10))
+        page = ledger_page(filtered, 1, 100)
+        page[DISPLAY_COLS].style.apply(style_audit_rows, axis=None).to_html()
+    with measure("delete_where_trip"):
+        backend.delete_where("expenses", "trip_id", "t0")
+
+
+APP_SCRIPT = '''
+import streamlit as st
+import bench, utils
+bench.seed_backend(utils.get_backend(), int(st.secrets["bench"]["rows"]), int(st.secrets["bench"]["seed"]))
+{body}
+'''
+
+
+def bench_app(n_rows, args, results):
+    # utils と各タブの描画を AppTest でヘッドレスに実行する (memory バックエンド)
+    import streamlit as st
+    from streamlit.testing.v1 import AppTest
+    import utils
+
+    st.cache_resource.clear()
+    queue_path = os.path.join(tempfile.mkdtemp(prefix="bench_"), "queue.jsonl")
+
+    def app(body):
+        at = AppTest.from_string(APP_SCRIPT.format(body=body), default_timeout=APP_TIMEOUT)
+        at.secrets["storage"] = {
+            "backend": "memory", "latency": args.latency, "error_rate": args.error_rate,
+            "quota_per_minute": 0, "queue_path": queue_path,
+        }
+        at.secrets["bench"] = {"rows": n_rows, "seed": args.seed}
+        return at
+
+    def run(at):
+        at.run()
+        if at.exception:
+            raise RuntimeError(f"AppTest 失敗: {[e.value for e in at.exception]}")
+        return at
+
+    run(app(""))
+    backend = utils.get_backend()
+    sp, client = backend.spreadsheet, backend.client
+    sp.set_faults(args.latency, args.error_rate)
+
+    def measure(name):
+        m = Measurement(name, n_rows, sp, client, memory=not args.no_memory)
+        results.append(m)
+        return m
+
+    with measure("app_audit_all_cold"):
+        at = run(app("import tabs.audit\ntabs.audit.render()"))
+    with measure("app_audit_all_warm"):
+        run(at)
+    with measure("app_audit_trip"):
+        at.selectbox[0].set_value("t1")
+        run(at)
+    with measure("app_admin"):
+        run(app("import tabs.admin\ntabs.admin.render()"))
+    # 書き込み系は st.rerun() を呼ぶため 1 回だけ実行する
+    once = "if not st.session_state.get('done'):\n    st.session_state.done = True\n    {call}"
+    with measure("app_update_expense"):
+        run(app(once.format(call="utils.update_expense('e1', '食事', 'bench', 1234, 5, '', '2024-01-01', False)")))
+    with measure("sync_update_expense"):
+        utils.get_write_queue().flush(APP_TIMEOUT)
+    with measure("app_delete_trip_cascade"):
+        run(app(once.format(call="utils.delete_trip_cascade('t2', '旅行2')")))
+    with measure("sync_delete_trip_cascade"):
+        utils.get_write_queue().flush(APP_TIMEOUT)
+
+
+# --- ベースライン ---
+
+def result_key(m):
+    return f"{m.name}@{m.rows}"
+
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compare(m, base):
+    # 劣化した指標の説明を返す
+    problems = []
+    r = m.result
+    if r["api_calls"] > base["api_calls"]:
+        problems.append(f"api_calls {base['api_calls']} → {r['api_calls']}")
+    if r["wall"] > base["wall"] * (1 + WALL_TOLERANCE) and r["wall"] - base["wall"] > 0.05:
+        problems.append(f"wall {base['wall']:.3f}s → {r['wall']:.3f}s")
+    if base["peak_mb"] and r["peak_mb"] > base["peak_mb"] * (1 + MEMORY_TOLERANCE) and r["peak_mb"] - base["peak_mb"] > 1:
+        problems.append(f"peak {base['peak_mb']}MB → {r['peak_mb']}MB")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Travel Audit Log のオフラインベンチマーク")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="支出の行数 (カンマ区切り)")
+    parser.add_argument("--latency", type=float, default=0.0, help="API 呼び出し 1 回あたりの擬似遅延 (秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="API 呼び出しが 429 になる確率")
+    parser.add_argument("--backoff", type=float, default=0.05, help="backend ベンチでの再試行の基本待ち時間 (秒)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", choices=["backend", "app"], help="一方のベンチだけを実行する")
+    parser.add_argument("--no-memory", action="store_true", help="tracemalloc を使わない (実時間のみ)")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--output", help="結果を JSON で保存するパス")
+    args = parser.parse_args(argv)
+
+    # 初回 import・JIT 的な初期化の時間が最小サイズの結果に混ざらないよう、小さなデータで 1 度空回しする
+    if args.only != "app":
+        bench_backend(100, args, [])
+    if args.only != "backend":
+        bench_app(100, args, [])
+
+    results = []
+    for n_rows in [int(s) for s in args.sizes.split(",") if s]:
+        if args.only != "app":
+            bench_backend(n_rows, args, results)
+        if args.only != "backend":
+            bench_app(n_rows, args, results)
+
+    baselines = load_baselines(args.baseline)
+    # 擬似遅延・エラー・メモリ計測の有無が異なる場合は比較しない
+    conditions = {"latency": args.latency, "error_rate": args.error_rate, "memory": not args.no_memory, "seed": args.seed}
+    comparable = baselines.get("conditions") == conditions
+    regressions = 0
+    print(f"{'case':<28}{'rows':>9}{'wall(s)':>10}{'api':>7}{'retry':>7}{'peak(MB)':>10}  vs baseline")
+    for m in results:
+        r = m.result
+        base = baselines.get("results", {}).get(result_key(m)) if comparable else None
+        problems = compare(m, base) if base else []
+        regressions += bool(problems)
+        note = "REGRESSION: " + ", ".join(problems) if problems else ("ok" if base else "-")
+        print(f"{m.name:<28}{m.rows:>9,}{r['wall']:>10.3f}{r['api_calls']:>7}{r['retries']:>7}{r['peak_mb']:>10.2f}  {note}")
+    if baselines and not comparable:
+        print(f"※ ベースラインの計測条件 {baselines.get('conditions')} と異なるため比較していません")
+
+    report = {
+        "conditions": conditions,
+        "recorded_at": date.today().isoformat(),
+        "python": sys.version.split()[0],
+        "results": {result_key(m): m.result for m in results},
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        # 今回計測したケースだけ上書きする
+        if comparable:
+            report["results"] = {**baselines.get("results", {}), **report["results"]}
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"ベースラインを保存しました: {args.baseline}")
+    return 1 if regressions and not args.save_baseline else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
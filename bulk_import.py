@@ -0,0 +1,123 @@
+import uuid
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from sheet_cache import normalize_frame
+from storage import CATEGORIES, HEADERS
+
+# --- 設定 ---
+READ_CHUNK_ROWS = 5_000   # CSV を読み込む単位
+WRITE_CHUNK_ROWS = 500    # 1 回の append_rows で書き込む行数
+
+# 自前のエクスポート (英語列名) に加え、カード明細等の日本語列名も受け付ける
+COLUMN_ALIASES = {
+    "日付": "expense_date", "利用日": "expense_date", "支出日": "expense_date",
+    "品目": "item_name", "店名": "item_name", "利用店名": "item_name", "品目・店名": "item_name",
+    "金額": "amount", "利用金額": "amount",
+    "カテゴリ": "category", "満足度": "satisfaction", "メモ": "detail", "詳細": "detail", "浪費": "is_waste",
+}
+CATEGORY_ALIASES = {
+    "食費": "食事", "飲食": "食事", "ホテル": "宿泊", "交通費": "交通",
+    "娯楽": "娯楽/体験", "体験": "娯楽/体験", "観光": "娯楽/体験", "その他": "雑費",
+}
+TRUE_VALUES = {"TRUE", "1", "YES", "Y", "○", "はい"}
+# 内容ハッシュに使う列 (ID・記録時刻・評価は含めない)
+HASH_COLUMNS = ["trip_id", "expense_date", "category", "item_name", "amount", "detail"]
+
+
+def read_chunks(f, chunk_rows=READ_CHUNK_ROWS):
+    # すべて文字列として読み、型変換は prepare_chunk でまとめて行う
+    return pd.read_csv(f, dtype=str, keep_default_na=False, encoding="utf-8-sig", chunksize=chunk_rows)
+
+
+def prepare_chunk(raw, trip_id, known_trips, now, known_categories=CATEGORIES):
+    # CSV の 1 チャンクを検証・正規化し、(書き込む行の DataFrame (HEADERS 順), 不正行の DataFrame) を返す。
+    # trip_id が None なら CSV の trip_id 列を使う。
+    # known_categories (台帳で使われているカテゴリ) に無いカテゴリは雑費にする
+    df = raw.rename(columns=lambda c: COLUMN_ALIASES.get(str(c).strip(), str(c).strip()))
+    blank = pd.Series("", index=df.index, dtype=object)
+    col = lambda name: df[name].astype(str).str.strip() if name in df.columns else blank
+
+    trips = col("trip_id") if trip_id is None else pd.Series(str(trip_id), index=df.index)
+    items = col("item_name")
+    amounts = pd.to_numeric(col("amount").str.replace(r"[,¥円\s]", "", regex=True), errors="coerce")
+    sats = pd.to_numeric(col("satisfaction").replace("", "0"), errors="coerce")
+    timestamps = col("timestamp")
+    date_raw = col("expense_date")
+    dates = pd.to_datetime(date_raw.replace("", None), errors="coerce", format="mixed")
+    # 日付が空なら記録時刻の日付、それも無ければ取り込み日
+    fallback = pd.to_datetime(timestamps.str.split(" ").str[0].replace("", None), errors="coerce", format="mixed")
+    empty = date_raw == ""
+    dates = dates.fillna(fallback.where(empty))
+    dates = dates.mask(empty & dates.isna(), pd.Timestamp(now.date()))
+
+    categories = col("category").str.normalize("NFKC").replace(CATEGORY_ALIASES)
+    # 台帳に既にある独自カテゴリは残す (雑費にすると内容ハッシュが変わり、既存行との重複を検出できない)
+    categories = categories.where(categories.isin(CATEGORIES) | categories.isin(known_categories), "雑費")
+
+    reason = pd.Series(np.select(
+        [
+            ~trips.isin(known_trips),
+            items == "",
+            amounts.isna(),
+            amounts < 0,
+            dates.isna(),
+            sats.isna() | (sats < 0) | (sats > 10),
+        ],
+        ["不明な trip_id", "品目が空", "金額が不正", "金額が負", "日付が不正", "満足度が不正 (0-10)"],
+        default="",
+    ), index=df.index)
+    ok = reason == ""
+
+    rows = pd.DataFrame({
+        "entry_id": [str(uuid.uuid4()) for _ in range(int(ok.sum()))],
+        "trip_id": trips[ok].values,
+        "timestamp": timestamps[ok].where(timestamps[ok] != "", now.strftime("%Y-%m-%d %H:%M:%S")).values,
+        "category": categories[ok].values,
+        "item_name": items[ok].values,
+        "amount": amounts[ok].astype("int64").values,
+        "satisfaction": sats[ok].astype("int64").values,
+        "detail": col("detail")[ok].values,
+        "expense_date": dates[ok].dt.strftime("%Y-%m-%d").values,
+        "is_waste": np.where(col("is_waste")[ok].str.upper().isin(TRUE_VALUES), "TRUE", "FALSE"),
+    }, columns=HEADERS["expenses"])
+    rejected = raw[~ok].assign(reason=reason[~ok])
+    return rows, rejected
+
+
+def content_hash(typed):
+    # 型変換済みの支出フレームの内容ハッシュ (取り込み行・既存行で同じ値になる)
+    if typed.empty:
+        return pd.Series([], dtype="uint64")
+    return pd.util.hash_pandas_object(typed[HASH_COLUMNS].astype(str), index=False)
+
+
+# 既存行との重複を内容ハッシュで除く。同じ内容の行が複数あってもよいよう件数で比較し、
+# ファイル中の n 件目は既存に n 件以上あれば重複とみなす。
+# 途中で失敗した取り込みを同じファイルでやり直すと、書き込み済みの行は飛ばされる。
+class Deduper:
+    def __init__(self, load_trip):
+        self.load_trip = load_trip
+        self.loaded = set()
+        self.existing = Counter()
+        self.seen = Counter()
+
+    def new_mask(self, rows):
+        if rows.empty:
+            return np.zeros(0, dtype=bool)
+        typed = normalize_frame("expenses", rows)
+        for trip_id in set(typed["trip_id"]) - self.loaded:
+            self.existing.update(content_hash(self.load_trip(trip_id)).tolist())
+            self.loaded.add(trip_id)
+        hashes = content_hash(typed)
+        occurrence = hashes.groupby(hashes).cumcount() + hashes.map(lambda h: self.seen[h])
+        keep = occurrence >= hashes.map(lambda h: self.existing[h])
+        self.seen.update(hashes.tolist())
+        return keep.to_numpy()
+
+
+def to_rows(df):
+    # JSON に書けるよう numpy の値を Python の値に戻す
+    return df.astype(object).values.tolist()
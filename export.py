@@ -0,0 +1,89 @@
+import os
+import re
+import tempfile
+import zipfile
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# --- 設定 ---
+CHUNK_ROWS = 50_000   # 1 回に書き出す行数
+
+FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Parquet": ("parquet", "application/octet-stream"),
+}
+
+
+def available_formats():
+    return [f for f in FORMATS if f != "Parquet" or pa is not None]
+
+
+# 台帳を行チャンク毎に一時ファイルへ書き出す。生成中に台帳全体の文字列・バイト列を作らないだけで、
+# st.download_button はダウンロード用にファイル全体をメモリ (メディアストア) に読み込んで保持する。
+# そのためダウンロード時のメモリ使用量はファイルサイズ分になる。
+
+def write_csv(df, f, chunk_rows=CHUNK_ROWS):
+    # Excel で文字化けしないよう BOM 付き UTF-8 (従来の to_csv(encoding='utf-8-sig') と同じ)
+    f.write("\ufeff".encode("utf-8"))
+    for start in range(0, max(len(df), 1), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows]
+        if "is_waste" in chunk and chunk["is_waste"].dtype == bool:
+            # シート・取り込みと同じ TRUE / FALSE で書く (型変換前の台帳の CSV と同じ)
+            chunk = chunk.assign(is_waste=np.where(chunk["is_waste"], "TRUE", "FALSE"))
+        f.write(chunk.to_csv(index=False, header=start == 0).encode("utf-8"))
+
+
+def write_parquet(df, f, chunk_rows=CHUNK_ROWS):
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(f, schema) as writer:
+        for start in range(0, max(len(df), 1), chunk_rows):
+            chunk = df.iloc[start:start + chunk_rows]
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+
+WRITERS = {"CSV": write_csv, "Parquet": write_parquet}
+
+
+def _spool():
+    return tempfile.TemporaryFile()
+
+
+def _reader(f):
+    # st.download_button が受け付けるのは bytes / BytesIO / BufferedReader 等で、一時ファイル (BufferedRandom) は不可。
+    # 同じ一時ファイルを読み取り専用で開き直して返す (ファイルは最後のハンドルが閉じられた時に消える)
+    f.flush()
+    reader = os.fdopen(os.dup(f.fileno()), "rb")
+    f.close()
+    reader.seek(0)
+    return reader
+
+
+def export_file(df, fmt):
+    # st.download_button(data=...) にそのまま渡せる、読み取り専用のファイルオブジェクトを返す
+    f = _spool()
+    WRITERS[fmt](df, f)
+    return _reader(f)
+
+
+def _safe_name(name):
+    return re.sub(r'[\\/:*?"<>|\s]+', "_", str(name)).strip("_") or "trip"
+
+
+def export_bundle(df_trips, trip_frames, fmt):
+    # trips 表と旅行毎の支出ファイルを 1 つの zip にまとめる。
+    # trip_frames は (trip_id, trip_name, df) を順に返す iterable で、1 旅行ずつ読み込んで書き出せる
+    ext = FORMATS[fmt][0]
+    f = _spool()
+    with zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        with zf.open(f"trips.{ext}", "w") as out:
+            WRITERS[fmt](df_trips, out)
+        for trip_id, trip_name, df in trip_frames:
+            with zf.open(f"expenses/{trip_id}_{_safe_name(trip_name)}.{ext}", "w") as out:
+                WRITERS[fmt](df, out)
+    return _reader(f)
@@ -0,0 +1,39 @@
+import threading
+from collections import OrderedDict
+
+from metrics import METRICS
+
+# --- 設定 ---
+MAX_FIGURES = 64   # 保持するグラフの上限。超えたら最も長く使われていないものから捨てる
+
+
+# 構築済みの Plotly Figure を (種類, trip_id, データの version...) をキーに保持する LRU。
+# キーに version を含めるため、データが変わると自然に別キーになり、古いものは LRU で押し出される。
+# Figure はセッション間で共有するので、取り出した側で変更しないこと。
+class FigureCache:
+    def __init__(self, max_entries=MAX_FIGURES):
+        self.max_entries = max_entries
+        self.figures = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        with self.lock:
+            fig = self.figures.get(key)
+            if fig is not None:
+                self.figures.move_to_end(key)
+                METRICS.incr("figures.hit")
+                return fig
+        # 構築はロックの外で行う (同時に同じキーを構築しても結果は同じ)
+        METRICS.incr("figures.miss")
+        with METRICS.timer(f"figures.build.{key[0]}"):
+            fig = build()
+        with self.lock:
+            self.figures[key] = fig
+            self.figures.move_to_end(key)
+            while len(self.figures) > self.max_entries:
+                self.figures.popitem(last=False)
+        return fig
+
+    def clear(self):
+        with self.lock:
+            self.figures.clear()
@@ -2,6 +2,8 @@ import streamlit as st
 import tabs.entry
 import tabs.audit
 import tabs.admin
+import utils
+from metrics import METRICS, profiled
 
 # ページ設定
 st.set_page_config(page_title="Travel Audit Log", layout="wide")
@@ -9,11 +11,21 @@ st.set_page_config(page_title="Travel Audit Log", layout="wide")
 st.title("Travel Audit Log")
 
 menu = ["支出記録 (Entry)", "台帳閲覧 (Audit)", "管理・修正 (Admin)"]
+pages = {
+    "支出記録 (Entry)": ("entry", tabs.entry.render),
+    "台帳閲覧 (Audit)": ("audit", tabs.audit.render),
+    "管理・修正 (Admin)": ("admin", tabs.admin.render),
+}
 choice = st.sidebar.radio("Menu", menu)
+utils.render_sync_status()
+utils.show_flash()
 
-if choice == "支出記録 (Entry)":
-    tabs.entry.render()
-elif choice == "台帳閲覧 (Audit)":
-    tabs.audit.render()
-elif choice == "管理・修正 (Admin)":
-    tabs.admin.render()
+name, render = pages[choice]
+with METRICS.timer(f"render.{name}"):
+    # 管理画面の診断タブで要求された場合は、この 1 回の再実行だけプロファイルを取る
+    if st.session_state.pop("_profile_next", False):
+        report = st.session_state["_profile_report"] = {"page": name}
+        with profiled(report):
+            render()
+    else:
+        render()
@@ -0,0 +1,117 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+# --- 設定 ---
+WINDOW = 512   # 指標毎に保持する直近の計測数 (p50 / p95 の算出用)
+
+
+# プロセス全体で共有する軽量な計測器。
+# 記録は perf_counter 2 回と deque への追加だけなので、本番で常時有効にしてよい。
+# 名前は "分類.対象" (例: api.get_all_records, render.audit, cache.expenses.hit) とする。
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.samples = {}
+            self.calls = Counter()
+            self.totals = Counter()
+            self.counters = Counter()
+            self.started_at = time.time()
+
+    def record(self, name, seconds):
+        with self.lock:
+            window = self.samples.get(name)
+            if window is None:
+                window = self.samples[name] = deque(maxlen=WINDOW)
+            window.append(seconds)
+            self.calls[name] += 1
+            self.totals[name] += seconds
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def timed(self, name):
+        # 関数全体を timer で囲むデコレータ
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        # JSON にそのまま書ける dict を返す (時間は秒)
+        with self.lock:
+            windows = {name: sorted(w) for name, w in self.samples.items()}
+            calls, totals, counters = dict(self.calls), dict(self.totals), dict(self.counters)
+        timings = {
+            name: {
+                "count": calls[name], "total": round(totals[name], 6),
+                "p50": round(_percentile(w, 0.50), 6), "p95": round(_percentile(w, 0.95), 6), "max": round(w[-1], 6),
+            }
+            for name, w in windows.items()
+        }
+        return {"since": self.started_at, "timings": timings, "counters": counters}
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+METRICS = Metrics()
+
+
+def count_http_bytes(session):
+    # requests のレスポンスフックで送受信バイト数を数える (gspread の HTTP セッション用)
+    def hook(response, *args, **kwargs):
+        METRICS.incr("bytes.received", len(response.content or b""))
+        body = response.request.body
+        METRICS.incr("bytes.sent", len(body) if body else 0)
+    session.hooks.setdefault("response", []).append(hook)
+
+
+@contextmanager
+def profiled(report, limit=40):
+    # ブロックを cProfile 付きで実行し、report に累積時間順の上位 limit 件のテキストと .prof のバイト列を入れる。
+    # st.rerun / st.stop の例外で抜けた場合も結果を残す
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield report
+    finally:
+        profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(limit)
+        fd, path = tempfile.mkstemp(suffix=".prof")
+        os.close(fd)
+        try:
+            profiler.dump_stats(path)
+            with open(path, "rb") as f:
+                report["raw"] = f.read()
+        finally:
+            os.remove(path)
+        report["text"] = out.getvalue()
+        report["at"] = time.time()
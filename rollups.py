@@ -0,0 +1,88 @@
+import threading
+from collections import defaultdict
+
+
+# 旅行 1 件分の集計値
+class TripRollup:
+    def __init__(self):
+        self.total = 0
+        self.waste = 0
+        self.pending = 0
+        self.count = 0
+        self.by_category = defaultdict(int)
+        self.by_day = defaultdict(int)
+
+    def as_dict(self):
+        return {
+            "total": self.total, "waste": self.waste, "pending": self.pending, "count": self.count,
+            "by_category": {k: v for k, v in self.by_category.items() if v},
+            "by_day": {k: v for k, v in self.by_day.items() if v},
+        }
+
+
+# 旅行毎の集計を保持し、支出キャッシュの差分 (追加行 / 削除行) で更新する。
+# SheetCache / TripCacheStore の listeners に登録して使う。
+class RollupStore:
+    def __init__(self):
+        self.trips = {}
+        self.lock = threading.RLock()
+
+    def _apply(self, df, sign):
+        if df is None or df.empty:
+            return
+        grouped = df.assign(
+            _waste=df['amount'].where(df['is_waste'], 0),
+            _pending=(df['satisfaction'] == 0).astype('int64'),
+            _day=df['expense_date'].dt.strftime("%Y-%m-%d").fillna(""),
+        )
+        totals = grouped.groupby('trip_id').agg(
+            total=('amount', 'sum'), waste=('_waste', 'sum'), pending=('_pending', 'sum'), count=('amount', 'size'))
+        by_cat = grouped.groupby(['trip_id', 'category'], observed=True)['amount'].sum()
+        by_day = grouped.groupby(['trip_id', '_day'])['amount'].sum()
+        for trip_id, row in totals.iterrows():
+            r = self.trips.setdefault(trip_id, TripRollup())
+            r.total += sign * int(row['total'])
+            r.waste += sign * int(row['waste'])
+            r.pending += sign * int(row['pending'])
+            r.count += sign * int(row['count'])
+        for (trip_id, cat), amount in by_cat.items():
+            self.trips[trip_id].by_category[str(cat)] += sign * int(amount)
+        for (trip_id, day), amount in by_day.items():
+            self.trips[trip_id].by_day[day] += sign * int(amount)
+        for trip_id in totals.index:
+            if self.trips[trip_id].count <= 0:
+                del self.trips[trip_id]
+
+    # --- SheetCache リスナー ---
+
+    def reset(self, df, scope=None):
+        # scope が trip_id の場合はその旅行の集計だけを作り直す
+        with self.lock:
+            if scope is None:
+                self.trips = {}
+            else:
+                self.trips.pop(str(scope), None)
+            self._apply(df, 1)
+
+    def drop(self, trip_id):
+        with self.lock:
+            self.trips.pop(str(trip_id), None)
+
+    def apply(self, removed, added):
+        with self.lock:
+            self._apply(removed, -1)
+            self._apply(added, 1)
+
+    # --- 参照・検証 ---
+
+    def get(self, trip_id):
+        with self.lock:
+            return self.trips.get(str(trip_id)) or TripRollup()
+
+    def verify(self, df):
+        # 差分更新の結果を台帳からの全件再集計と突き合わせ、不一致の trip_id を返す
+        fresh = RollupStore()
+        fresh.reset(df)
+        with self.lock:
+            ids = set(self.trips) | set(fresh.trips)
+            return sorted(t for t in ids if self.get(t).as_dict() != fresh.get(t).as_dict())
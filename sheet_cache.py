@@ -0,0 +1,302 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+from metrics import METRICS
+from storage import CATEGORIES, base_sheet
+
+# --- キャッシュ設定 ---
+FULL_REFRESH_TTL = 300   # 全件再取得の間隔 (秒)。他者による更新・削除はここで反映される
+DELTA_REFRESH_TTL = 30   # 末尾の新規行だけを取得する間隔 (秒)
+TRIP_REFRESH_TTL = 30    # 旅行単位キャッシュの再取得間隔 (秒)。対象行だけを読むため短めにする
+MAX_CACHED_TRIPS = 32
+
+
+# --- 型付きスキーマ ---
+
+def _to_str(s):
+    return s.fillna("").astype(str)
+
+def _to_int(s):
+    if not pd.api.types.is_numeric_dtype(s):
+        s = pd.to_numeric(s.astype(str).str.replace(",", "", regex=False).str.strip(), errors="coerce")
+    return s.fillna(0).astype("int64")
+
+def _to_bool(s):
+    if pd.api.types.is_bool_dtype(s):
+        return s
+    return s.astype(str).str.strip().str.upper() == "TRUE"
+
+def _to_date(s):
+    return pd.to_datetime(s, errors="coerce", format="mixed").dt.normalize()
+
+def to_category(s):
+    # 既定カテゴリの並びを保ち、未知の値はカテゴリとして末尾に追加する
+    values = _to_str(s.astype(object))
+    extras = sorted(set(values.unique()) - set(CATEGORIES))
+    return values.astype(pd.CategoricalDtype(CATEGORIES + extras))
+
+CONVERTERS = {
+    "trips": {
+        "trip_id": _to_str, "trip_name": _to_str, "start_date": _to_str, "end_date": _to_str,
+        "status": _to_str, "total_budget": _to_int, "detail": _to_str,
+    },
+    "expenses": {
+        "entry_id": _to_str, "trip_id": _to_str, "timestamp": _to_str, "category": to_category,
+        "item_name": _to_str, "amount": _to_int, "satisfaction": _to_int, "detail": _to_str,
+        "expense_date": _to_date, "is_waste": _to_bool,
+    },
+    "archive_manifest": {
+        "trip_id": _to_str, "partition": _to_str, "archived_at": _to_str, "row_count": _to_int,
+    },
+}
+
+def normalize_frame(sheet_name, df):
+    # アーカイブパーティション (expenses_2024 等) は expenses と同じ型で読む
+    sheet_name = base_sheet(sheet_name)
+    converters = CONVERTERS[sheet_name]
+    out = pd.DataFrame(index=df.index)
+    for col, conv in converters.items():
+        out[col] = conv(df[col] if col in df.columns else pd.Series("", index=df.index, dtype=object))
+    if sheet_name == "expenses" and len(out):
+        # expense_date 未記入の行は timestamp の日付部分で補う
+        ts_date = _to_date(out["timestamp"].str.split(" ").str[0])
+        out["expense_date"] = out["expense_date"].fillna(ts_date)
+    return out
+
+def convert_values(sheet_name, values):
+    converters = CONVERTERS[base_sheet(sheet_name)]
+    return {c: converters[c](pd.Series([v], dtype=object)).iloc[0] if c in converters else v for c, v in values.items()}
+
+
+# version はプロセス内の全キャッシュで一意の通し番号にする。LRU から追い出された旅行のキャッシュを
+# 作り直しても以前の番号を再利用しないため、(trip_id, version) を派生データのキーに使える
+_versions = itertools.count(1)
+
+
+# シート 1 枚分のバージョン付きキャッシュ。
+# ローカルの書き込みは再取得せずメモリ上の DataFrame に直接反映し、version を進める。
+# listeners には reset(df, scope) / apply(removed, added) を持つ集計器 (RollupStore 等) を登録できる。
+# scope は旅行単位のキャッシュなら trip_id、シート全体なら None。
+# snapshot (SnapshotStore) を設定すると全件取得の結果をディスクに保存し、起動直後の初回読み込みでは
+# marker() (ストアの version_marker) が保存時と同じならシートを読まずにスナップショットを使う。
+class SheetCache:
+    def __init__(self, sheet_name, header, scope=None, ttl=FULL_REFRESH_TTL):
+        self.sheet_name = sheet_name
+        self.header = header
+        self.scope = scope
+        self.ttl = ttl
+        self.key_col = header[0]
+        self.df = None
+        self.version = 0
+        self.row_count = 0
+        self.loaded_at = 0.0
+        self.checked_at = 0.0
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.pending_rows = lambda: []
+        self.snapshot = None
+        self.marker = lambda: None
+
+    def _notify(self, removed, added):
+        for listener in self.listeners:
+            listener.apply(removed, added)
+
+    def _frame(self, records):
+        # 型変換は読み込み時に一度だけ行い、各タブでは行わない
+        return normalize_frame(self.sheet_name, pd.DataFrame(records))
+
+    def get(self, read_all, read_tail):
+        # 旅行単位のキャッシュは旅行毎に分けず cache.trip.* にまとめて数える
+        stat = "cache.trip" if self.scope is not None else f"cache.{self.sheet_name}"
+        with self.lock:
+            now = time.monotonic()
+            if self.df is None or now - self.loaded_at > self.ttl:
+                # マーカーは読み込みより前に取る (読み込み中の他者の更新は次回の不一致で拾う)
+                marker = self.marker() if self.snapshot is not None else None
+                if self.df is None and marker is not None and self._restore(marker, now):
+                    METRICS.incr(f"{stat}.snapshot")
+                    return self.df
+                METRICS.incr(f"{stat}.miss")
+                records = read_all()
+                self.row_count = len(records)
+                # 未同期の追記行はシートにまだ無いため、再取得後も表示に残す
+                records = records + [dict(zip(self.header, r)) for r in self.pending_rows()]
+                self.df = self._frame(records)
+                self.loaded_at = self.checked_at = now
+                self.version = next(_versions)
+                for listener in self.listeners:
+                    listener.reset(self.df, self.scope)
+                if marker is not None:
+                    self.snapshot.save(self.sheet_name, self.df.iloc[:self.row_count], marker, self.row_count)
+            elif now - self.checked_at > DELTA_REFRESH_TTL:
+                # 他のセッションが追記した可能性のある範囲だけを取得する
+                METRICS.incr(f"{stat}.delta")
+                records = read_tail(self.row_count)
+                self.checked_at = now
+                if records:
+                    self.row_count += len(records)
+                    self._append(records)
+            else:
+                METRICS.incr(f"{stat}.hit")
+            return self.df
+
+    def _restore(self, marker, now):
+        restored = self.snapshot.load(self.sheet_name)
+        if restored is None or restored[1]["marker"] != marker:
+            return False
+        self.df, meta = restored
+        self.row_count = meta["row_count"]
+        self.loaded_at = self.checked_at = now
+        self.version = next(_versions)
+        for listener in self.listeners:
+            listener.reset(self.df, self.scope)
+        pending = self.pending_rows()
+        if pending:
+            self._append([dict(zip(self.header, r)) for r in pending])
+        return True
+
+    def _append(self, records):
+        new = self._frame(records)
+        if self.df is not None and not self.df.empty:
+            # 楽観的に反映済みの行が後から差分取得で戻ってきた場合は重複させない
+            # 大きい既存列の側を少数の新規キーで引く (逆向きの isin は既存行数に比例して遅い)
+            existing = self.df[self.key_col]
+            dup = existing[existing.isin(new[self.key_col])]
+            new = new[~new[self.key_col].isin(dup)]
+            if new.empty:
+                return
+        if self.df is None or self.df.empty:
+            self.df = new
+        else:
+            for col in new.columns:
+                dtype = self.df[col].dtype
+                if isinstance(dtype, pd.CategoricalDtype):
+                    # カテゴリ型を揃えないと concat で文字列列に戻ってしまう
+                    missing = sorted(set(new[col].astype(str)) - set(dtype.categories))
+                    if missing:
+                        dtype = pd.CategoricalDtype(list(dtype.categories) + missing)
+                        self.df[col] = self.df[col].astype(dtype)
+                    new[col] = new[col].astype(str).astype(dtype)
+            self.df = pd.concat([self.df, new], ignore_index=True)
+        self.version = next(_versions)
+        self._notify(None, new)
+
+    # apply_* はメモリ上の表示だけを更新する。シート上の行数 (row_count) は
+    # 書き込みが実際に反映された時点で adjust_row_count で合わせる。
+    def apply_append(self, rows):
+        with self.lock:
+            if self.df is None:
+                return
+            self._append([dict(zip(self.header, r)) for r in rows])
+
+    def apply_update(self, key, values):
+        with self.lock:
+            if self.df is None or self.df.empty:
+                return
+            mask = self.df[self.key_col] == str(key)
+            if not mask.any():
+                return
+            before = self.df[mask].copy()
+            for col, val in convert_values(self.sheet_name, values).items():
+                series = self.df[col]
+                if isinstance(series.dtype, pd.CategoricalDtype) and val not in series.cat.categories:
+                    self.df[col] = series.cat.add_categories([val])
+                self.df.loc[mask, col] = val
+            self.version = next(_versions)
+            self._notify(before, self.df[mask])
+
+    def apply_delete(self, column, value, first_only=False):
+        with self.lock:
+            if self.df is None or self.df.empty or column not in self.df.columns:
+                return 0
+            mask = self.df[column] == str(value)
+            if first_only and mask.any():
+                first = mask.idxmax()
+                mask = pd.Series(False, index=self.df.index)
+                mask[first] = True
+            removed = int(mask.sum())
+            if removed:
+                dropped = self.df[mask]
+                self.df = self.df[~mask].reset_index(drop=True)
+                self.version = next(_versions)
+                self._notify(dropped, None)
+            return removed
+
+    def adjust_row_count(self, delta):
+        with self.lock:
+            self.row_count += delta
+
+    def invalidate(self):
+        with self.lock:
+            self.df = None
+
+
+# 旅行毎の支出だけを保持する SheetCache の LRU。シート全体を読まずに 1 旅行分を表示するために使う。
+# 書き込みはキャッシュ済みの旅行にだけ反映する (未キャッシュの旅行は次回読み込み時に取得される)。
+class TripCacheStore:
+    def __init__(self, sheet_name, header, max_trips=MAX_CACHED_TRIPS):
+        self.sheet_name = sheet_name
+        self.header = header
+        self.trip_pos = header.index("trip_id")
+        self.max_trips = max_trips
+        self.caches = OrderedDict()
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.pending_rows = lambda: []
+
+    def _cache_for(self, trip_id):
+        with self.lock:
+            cache = self.caches.get(trip_id)
+            if cache is None:
+                cache = SheetCache(self.sheet_name, self.header, scope=trip_id, ttl=TRIP_REFRESH_TTL)
+                cache.listeners = self.listeners
+                cache.pending_rows = lambda: [r for r in self.pending_rows() if str(r[self.trip_pos]) == trip_id]
+                self.caches[trip_id] = cache
+            self.caches.move_to_end(trip_id)
+            while len(self.caches) > self.max_trips:
+                evicted, _ = self.caches.popitem(last=False)
+                for listener in self.listeners:
+                    listener.drop(evicted)
+            return cache
+
+    def get(self, trip_id, read_trip):
+        trip_id = str(trip_id)
+        return self._cache_for(trip_id).get(lambda: read_trip(trip_id), lambda offset: [])
+
+    def cached(self):
+        with self.lock:
+            return list(self.caches.values())
+
+    def version(self, trip_id):
+        with self.lock:
+            cache = self.caches.get(str(trip_id))
+            return cache.version if cache else 0
+
+    def apply_append(self, rows):
+        by_trip = {}
+        for r in rows:
+            by_trip.setdefault(str(r[self.trip_pos]), []).append(r)
+        with self.lock:
+            targets = [(self.caches[t], rs) for t, rs in by_trip.items() if t in self.caches]
+        for cache, rs in targets:
+            cache.apply_append(rs)
+
+    def apply_update(self, key, values):
+        for cache in self.cached():
+            cache.apply_update(key, values)
+
+    def apply_delete(self, column, value, first_only=False):
+        removed = 0
+        for cache in self.cached():
+            removed += cache.apply_delete(column, value, first_only=first_only)
+            if first_only and removed:
+                break
+        return removed
+
+    def invalidate(self):
+        for cache in self.cached():
+            cache.invalidate()
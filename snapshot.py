@@ -0,0 +1,52 @@
+import json
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# 列構成や型変換 (sheet_cache.CONVERTERS) を変えたら上げる。古い形式のスナップショットは読まない
+SNAPSHOT_FORMAT = 1
+META_KEY = b"travel_audit"
+
+
+# 正規化済みのシート DataFrame を Parquet でディスクに保存し、プロセス・レプリカ間で共有する。
+# 保存時のストアの version_marker を Parquet のメタデータに埋め込み、
+# 起動時にマーカーが一致すればシートを読まずにそのまま使う。
+class SnapshotStore:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def available():
+        return pa is not None
+
+    def _path(self, sheet_name):
+        return os.path.join(self.directory, f"{sheet_name}.parquet")
+
+    def load(self, sheet_name):
+        # (df, meta) を返す。無い・壊れている・形式が古い場合は None
+        try:
+            table = pq.read_table(self._path(sheet_name))
+            meta = json.loads((table.schema.metadata or {}).get(META_KEY, b"{}"))
+        except (OSError, ValueError, pa.ArrowException):
+            return None
+        if meta.get("format") != SNAPSHOT_FORMAT:
+            return None
+        return table.to_pandas(), meta
+
+    def save(self, sheet_name, df, marker, row_count):
+        meta = {"format": SNAPSHOT_FORMAT, "marker": marker, "row_count": row_count}
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), META_KEY: json.dumps(meta).encode()})
+        # 他プロセスが読み込み中でも壊れたファイルを見せないよう、一時ファイルから置き換える
+        tmp = f"{self._path(sheet_name)}.{os.getpid()}.tmp"
+        try:
+            pq.write_table(table, tmp)
+            os.replace(tmp, self._path(sheet_name))
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
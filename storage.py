@@ -0,0 +1,782 @@
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+import gspread
+
+from api_client import QuotaClient, RETRYABLE_STATUS, error_status
+
+# --- スキーマ定義 ---
+HEADERS = {
+    "trips": ["trip_id", "trip_name", "start_date", "end_date", "status", "total_budget", "detail"],
+    "expenses": ["entry_id", "trip_id", "timestamp", "category", "item_name", "amount", "satisfaction", "detail", "expense_date", "is_waste"],
+    "archive_manifest": ["trip_id", "partition", "archived_at", "row_count"],
+}
+INTEGER_COLUMNS = {"total_budget", "amount", "satisfaction", "row_count"}
+CATEGORIES = ["食事", "宿泊", "交通", "娯楽/体験", "雑費"]
+# 行インデックスに ID と併せて保持する列 (カスケード削除の対象列)
+INDEX_TAGS = {"expenses": "trip_id"}
+
+# アーカイブ: 完了済み旅行の支出は年毎のパーティション (expenses_2024 等) へ移し、
+# どの旅行がどこにあるかを archive_manifest に記録する
+MANIFEST_SHEET = "archive_manifest"
+PARTITION_PREFIX = "expenses_"
+_PARTITION_RE = re.compile(r"^expenses_\d{4}$")
+
+# バックエンド共通の一時的エラー (リトライ対象)
+TRANSIENT_ERRORS = (gspread.exceptions.APIError, sqlite3.OperationalError)
+
+
+def is_transient(e):
+    # 時間をおいて再送すれば成功しうるエラーか (クォータ超過・サーバー側の一時障害・SQLite のロック競合)。
+    # 400 / 403 / 404 や "no such column" 等は何度送っても失敗する
+    if isinstance(e, gspread.exceptions.APIError):
+        return error_status(e) in RETRYABLE_STATUS
+    if isinstance(e, sqlite3.OperationalError):
+        message = str(e).lower()
+        return "locked" in message or "busy" in message
+    return False
+
+
+class StorageError(Exception):
+    pass
+
+
+def col_letter(col):
+    letters = ""
+    while col:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def parse_a1(cell):
+    m = re.match(r"^([A-Z]+)(\d+)$", cell)
+    col = 0
+    for ch in m.group(1):
+        col = col * 26 + ord(ch) - 64
+    return int(m.group(2)), col
+
+
+def contiguous_runs(header, values):
+    # {列名: 値} を (開始列番号, [値...]) の連続ブロックに分割する
+    cols = sorted((header.index(c) + 1, v) for c, v in values.items())
+    runs = []
+    for col, val in cols:
+        if runs and runs[-1][0] + len(runs[-1][1]) == col:
+            runs[-1][1].append(val)
+        else:
+            runs.append((col, [val]))
+    return runs
+
+
+def partition_name(year):
+    return f"{PARTITION_PREFIX}{year}"
+
+
+def is_partition(sheet_name):
+    return bool(_PARTITION_RE.match(str(sheet_name)))
+
+
+def base_sheet(sheet_name):
+    # アーカイブパーティションは expenses と同じスキーマを持つ
+    return "expenses" if is_partition(sheet_name) else sheet_name
+
+
+def header_for(sheet_name):
+    if base_sheet(sheet_name) not in HEADERS:
+        raise StorageError(f"未知のシート名: {sheet_name}")
+    return HEADERS[base_sheet(sheet_name)]
+
+
+def index_tag(sheet_name):
+    return INDEX_TAGS.get(base_sheet(sheet_name))
+
+
+# --- インターフェース ---
+
+# trips / expenses の行ストア。行は HEADERS 順のリスト、レコードは {列名: 値} の dict。
+# sheet_name にはアーカイブパーティション名 (expenses_2024 等) も指定できる。
+class StorageBackend:
+    def read_records(self, sheet_name):
+        raise NotImplementedError
+
+    # offset 件目 (0 始まり) 以降のデータ行のみを返す (差分取得用)
+    def read_tail(self, sheet_name, offset):
+        raise NotImplementedError
+
+    # ストア全体の更新を表す値 (最終更新時刻等)。変わっていなければ前回読んだ内容のままとみなせる。
+    # 取得できない場合は None
+    def version_marker(self):
+        return None
+
+    # 指定旅行の支出レコードだけを返す
+    def read_trip(self, trip_id, sheet_name="expenses"):
+        return [r for r in self.read_records(sheet_name) if str(r.get("trip_id", "")) == str(trip_id)]
+
+    def append_rows(self, sheet_name, rows):
+        raise NotImplementedError
+
+    # keys (1列目の ID) のうち既にシートにあるものの集合 (送信済みか不明な追記の再送前の確認用)
+    def existing_keys(self, sheet_name, keys):
+        keys = {str(k) for k in keys}
+        key_col = header_for(sheet_name)[0]
+        return {str(r.get(key_col, "")) for r in self.read_records(sheet_name)} & keys
+
+    # key (1列目の ID) に一致する行の values {列名: 値} の列を書き換える
+    def update_row(self, sheet_name, key, values):
+        raise NotImplementedError
+
+    # col 列目が value に一致する最初の行を削除する
+    def delete_row(self, sheet_name, value, col=1):
+        raise NotImplementedError
+
+    # column == value の行をすべて削除し、削除件数を返す
+    def delete_where(self, sheet_name, column, value):
+        raise NotImplementedError
+
+
+# --- Google Sheets ---
+
+# 1列目の ID → シート上の行番号 (ヘッダ行が 1 行目)。ids[i] が i + 2 行目に対応する。
+# tags には INDEX_TAGS の列値 (expenses なら trip_id) を同じ並びで保持する。
+class RowIndex:
+    def __init__(self, ids, tags=None):
+        self.ids = [str(k) for k in ids]
+        self.tags = [str(t) for t in tags] if tags is not None else None
+        self._pos = None
+        self._runs = None
+
+    def row_of(self, key):
+        if self._pos is None:
+            self._pos = {}
+            for i, k in enumerate(self.ids):
+                self._pos.setdefault(k, i)
+        i = self._pos.get(str(key))
+        return None if i is None else i + 2
+
+    def set_rows(self, start_row, keys, tags=None):
+        start = start_row - 2
+        if len(self.ids) < start:
+            self.ids.extend([""] * (start - len(self.ids)))
+        self.ids[start:start + len(keys)] = [str(k) for k in keys]
+        if self.tags is not None:
+            if tags is None:
+                self.tags = None
+            else:
+                self.tags.extend([""] * (len(self.ids) - len(self.tags)))
+                self.tags[start:start + len(tags)] = [str(t) for t in tags]
+        self._pos = None
+        self._runs = None
+
+    def remove_rows(self, start_row, end_row):
+        # 削除行より下の行番号はすべて繰り上がる
+        del self.ids[start_row - 2:end_row - 1]
+        if self.tags is not None:
+            del self.tags[start_row - 2:end_row - 1]
+        self._pos = None
+        self._runs = None
+
+    def tag_runs(self, tag):
+        # tag に一致する行を (開始行, 終了行) の連続ブロックで返す。
+        # tag → ブロック一覧は 1 回の走査でまとめて作り、行の追加・削除まで使い回す。
+        if self._runs is None:
+            self._runs = {}
+            for i, t in enumerate(self.tags):
+                runs = self._runs.setdefault(t, [])
+                if runs and runs[-1][1] == i + 1:
+                    runs[-1][1] = i + 2
+                else:
+                    runs.append([i + 2, i + 2])
+        return [tuple(r) for r in self._runs.get(str(tag), [])]
+
+
+def _flatten_column(value_range):
+    return [str(r[0]) if r else "" for r in value_range]
+
+
+def _runs_of(values, target, first_row):
+    runs = []
+    for i, v in enumerate(values):
+        if str(v) != str(target):
+            continue
+        row = first_row + i
+        if runs and runs[-1][1] == row - 1:
+            runs[-1][1] = row
+        else:
+            runs.append([row, row])
+    return [tuple(r) for r in runs]
+
+
+_NUMBER_RE = re.compile(r"^-?\d+(\.\d+)?$")
+
+
+def _numericise(value):
+    # get_all_records() と同様に数値文字列を数値へ変換する
+    if isinstance(value, str) and _NUMBER_RE.match(value):
+        return float(value) if "." in value else int(value)
+    return value
+
+
+def _values_to_records(header, rows):
+    return [
+        {c: _numericise(row[i]) if i < len(row) else "" for i, c in enumerate(header)}
+        for row in rows
+    ]
+
+
+def _updated_start_row(response):
+    # append_rows のレスポンス ("updates.updatedRange": "expenses!A12:J13") から書き込み開始行を得る
+    try:
+        rng = response["updates"]["updatedRange"].split("!")[-1]
+        return parse_a1(rng.split(":")[0].replace("$", ""))[0]
+    except (KeyError, TypeError, AttributeError, IndexError):
+        return None
+
+
+class SheetsBackend(StorageBackend):
+    def __init__(self, spreadsheet, client=None):
+        self.spreadsheet = spreadsheet
+        # すべての API 呼び出しは QuotaClient を経由する (流量制限・再試行・読み取りの集約)
+        self.client = client or QuotaClient()
+        self._worksheets = {}
+        self._indexes = {}
+        self._index_lock = threading.RLock()
+
+    def worksheet(self, sheet_name):
+        # sheet.worksheet() はメタデータ取得の API 呼び出しになるため使い回す
+        ws = self._worksheets.get(sheet_name)
+        if ws is None:
+            try:
+                ws = self.client.read(("worksheet", sheet_name), self.spreadsheet.worksheet, sheet_name)
+            except gspread.exceptions.WorksheetNotFound:
+                if not (is_partition(sheet_name) or sheet_name == MANIFEST_SHEET):
+                    raise StorageError(f"ワークシート '{sheet_name}' が見つかりません。")
+                ws = self._create_worksheet(sheet_name)
+            self._worksheets[sheet_name] = ws
+        return ws
+
+    def _create_worksheet(self, sheet_name):
+        # アーカイブ用のシートは初回利用時にヘッダー付きで作成する
+        header = header_for(sheet_name)
+        ws = self.client.call(self.spreadsheet.add_worksheet, title=sheet_name, rows=1000, cols=len(header))
+        self.client.call(ws.update, range_name="A1", values=[header])
+        return ws
+
+    def _find_row(self, ws, value, col=1):
+        cell = self.client.read(("find", ws.title, str(value), col), ws.find, str(value), in_column=col)
+        if cell is None:
+            raise StorageError(f"ID '{value}' が見つかりません。")
+        return cell.row
+
+    def _read_index_columns(self, sheet_name, start_row):
+        # start_row 以降の ID 列と tag 列だけを読む
+        ws = self.worksheet(sheet_name)
+        letter = col_letter(header_for(sheet_name).index(index_tag(sheet_name)) + 1)
+        ranges = [f"A{start_row}:A", f"{letter}{start_row}:{letter}"]
+        id_range, tag_range = self.client.read(("batch_get", sheet_name, *ranges), ws.batch_get, ranges)
+        ids, tags = _flatten_column(id_range), _flatten_column(tag_range)
+        tags.extend([""] * (len(ids) - len(tags)))
+        return ids, tags[:len(ids)]
+
+    def _rebuild_index(self, sheet_name):
+        ws = self.worksheet(sheet_name)
+        if index_tag(sheet_name):
+            index = RowIndex(*self._read_index_columns(sheet_name, 2))
+        else:
+            index = RowIndex(self.client.read(("col_values", sheet_name, 1), ws.col_values, 1)[1:])
+        with self._index_lock:
+            self._indexes[sheet_name] = index
+        return index
+
+    def _refresh_index_tail(self, sheet_name):
+        # 他セッションの追記分だけインデックスへ取り込む
+        with self._index_lock:
+            index = self._indexes.get(sheet_name)
+            known = len(index.ids) if index is not None and index.tags is not None else None
+        if known is None:
+            return self._rebuild_index(sheet_name)
+        ids, tags = self._read_index_columns(sheet_name, known + 2)
+        with self._index_lock:
+            if ids and self._indexes.get(sheet_name) is index and len(index.ids) == known:
+                index.set_rows(known + 2, ids, tags)
+        return index
+
+    def _locate(self, sheet_name, key):
+        # インデックスから行番号を引き、書き込み前にシート側の A 列で照合する。
+        # 不一致 (他者の編集でずれた等) の場合のみ ID 列を取り直す。
+        ws = self.worksheet(sheet_name)
+        with self._index_lock:
+            index = self._indexes.get(sheet_name)
+            row_num = index.row_of(key) if index else None
+        if row_num is not None and str(self.client.read(("cell", sheet_name, row_num, 1), ws.cell, row_num, 1).value) == str(key):
+            return row_num
+        row_num = self._rebuild_index(sheet_name).row_of(key)
+        if row_num is None:
+            raise StorageError(f"ID '{key}' が見つかりません。")
+        return row_num
+
+    def version_marker(self):
+        # Drive API のファイル更新時刻 (スプレッドシート全体で 1 つ)
+        if not hasattr(self.spreadsheet, "get_lastUpdateTime"):
+            return None
+        try:
+            return str(self.client.read(("last_update",), self.spreadsheet.get_lastUpdateTime))
+        except gspread.exceptions.APIError:
+            return None
+
+    def read_records(self, sheet_name):
+        ws = self.worksheet(sheet_name)
+        records = self.client.read(("get_all_records", sheet_name), ws.get_all_records)
+        key_col = header_for(sheet_name)[0]
+        tag_col = index_tag(sheet_name)
+        tags = [r.get(tag_col, "") for r in records] if tag_col else None
+        with self._index_lock:
+            self._indexes[sheet_name] = RowIndex([r.get(key_col, "") for r in records], tags)
+        return records
+
+    def read_tail(self, sheet_name, offset):
+        header = header_for(sheet_name)
+        ws = self.worksheet(sheet_name)
+        start_row = offset + 2
+        range_name = f"A{start_row}:{col_letter(len(header))}"
+        rows = self.client.read(("get_values", sheet_name, range_name), ws.get_values, range_name)
+        records = _values_to_records(header, rows)
+        tag_col = index_tag(sheet_name)
+        with self._index_lock:
+            index = self._indexes.get(sheet_name)
+            if index is not None and records and len(index.ids) >= offset:
+                index.set_rows(start_row, [r[header[0]] for r in records],
+                               [r.get(tag_col, "") for r in records] if tag_col else None)
+        return records
+
+    def read_trip(self, trip_id, sheet_name="expenses"):
+        # trip_id → 行ブロックのインデックスから対象範囲だけを batch_get で取得する
+        header = header_for(sheet_name)
+        ws = self.worksheet(sheet_name)
+        last = col_letter(len(header))
+        tag_pos = header.index("trip_id")
+        index = self._refresh_index_tail(sheet_name)
+        for attempt in range(2):
+            with self._index_lock:
+                runs = index.tag_runs(trip_id)
+                expected = [k for a, b in runs for k in index.ids[a - 2:b - 1]]
+            if not runs:
+                return []
+            ranges = [f"A{a}:{last}{b}" for a, b in runs]
+            value_ranges = self.client.read(("batch_get", sheet_name, *ranges), ws.batch_get, ranges)
+            rows = []
+            for (a, b), vr in zip(runs, value_ranges):
+                block = [list(r) for r in vr]
+                rows.extend(block + [[] for _ in range(b - a + 1 - len(block))])
+            if [str(r[0]) if r else "" for r in rows] == expected:
+                break
+            # 他者の削除等で行がずれていたらインデックスを取り直して 1 度だけやり直す
+            index = self._rebuild_index(sheet_name)
+        rows = [r for r in rows if len(r) > tag_pos and str(r[tag_pos]) == str(trip_id)]
+        return _values_to_records(header, rows)
+
+    def append_rows(self, sheet_name, rows):
+        if not rows:
+            return
+        ws = self.worksheet(sheet_name)
+        response = self.client.call(ws.append_rows, rows)
+        start_row = _updated_start_row(response)
+        with self._index_lock:
+            index = self._indexes.get(sheet_name)
+            if index is None:
+                return
+            if start_row is None:
+                self._indexes.pop(sheet_name, None)
+            else:
+                tag_col = index_tag(sheet_name)
+                tag_pos = header_for(sheet_name).index(tag_col) if tag_col else None
+                tags = [r[tag_pos] if tag_pos < len(r) else "" for r in rows] if tag_col else None
+                index.set_rows(start_row, [r[0] for r in rows], tags)
+
+    def existing_keys(self, sheet_name, keys):
+        # 他セッションや送信済みか不明な自分の追記も含め、末尾の ID 列だけ取り込んで照合する
+        index = self._refresh_index_tail(sheet_name)
+        with self._index_lock:
+            return {str(k) for k in keys if index.row_of(k) is not None}
+
+    def update_row(self, sheet_name, key, values):
+        header = header_for(sheet_name)
+        ws = self.worksheet(sheet_name)
+        unknown = [c for c in values if c not in header]
+        if unknown:
+            raise StorageError(f"未知の列: {unknown}")
+        row_num = self._locate(sheet_name, key)
+        # 1 リクエストで書き込み、途中失敗による行の半端な更新を防ぐ
+        data = [
+            {"range": f"{col_letter(col)}{row_num}:{col_letter(col + len(vals) - 1)}{row_num}", "values": [vals]}
+            for col, vals in contiguous_runs(header, values)
+        ]
+        if len(data) == 1:
+            self.client.call(ws.update, range_name=data[0]["range"], values=data[0]["values"], value_input_option="USER_ENTERED")
+        elif data:
+            self.client.call(ws.batch_update, data, value_input_option="USER_ENTERED")
+
+    def delete_row(self, sheet_name, value, col=1):
+        ws = self.worksheet(sheet_name)
+        row_num = self._locate(sheet_name, value) if col == 1 else self._find_row(ws, value, col)
+        if hasattr(ws, 'delete_rows'): self.client.call(ws.delete_rows, row_num)
+        else: self.client.call(ws.delete_row, row_num)
+        with self._index_lock:
+            index = self._indexes.get(sheet_name)
+            if index is not None:
+                index.remove_rows(row_num, row_num)
+
+    def _match_runs(self, sheet_name, column, value):
+        # 削除対象の連続行ブロックを求める。インデックスの tags が使えれば末尾の追記分だけ取り込み、
+        # 対象行の A 列だけを読んで照合し、ずれていれば列を取り直す。
+        ws = self.worksheet(sheet_name)
+        if column == index_tag(sheet_name):
+            # インデックス作成後に他セッションが追記した行も対象にする (read_trip と同じ)
+            self._refresh_index_tail(sheet_name)
+            with self._index_lock:
+                index = self._indexes.get(sheet_name)
+                runs = index.tag_runs(value) if index is not None and index.tags is not None else None
+                expected = [index.ids[a - 2:b - 1] for a, b in runs] if runs else []
+            if runs is not None:
+                if not runs:
+                    return runs
+                ranges = [f"A{a}:A{b}" for a, b in runs]
+                actual = [_flatten_column(vr) for vr in self.client.read(("batch_get", sheet_name, *ranges), ws.batch_get, ranges)]
+                actual = [vals + [""] * (len(exp) - len(vals)) for vals, exp in zip(actual, expected)]
+                if actual == expected:
+                    return runs
+            return self._rebuild_index(sheet_name).tag_runs(value)
+        col = header_for(sheet_name).index(column) + 1
+        return _runs_of(self.client.read(("col_values", sheet_name, col), ws.col_values, col)[1:], value, 2)
+
+    def delete_where(self, sheet_name, column, value):
+        if column not in header_for(sheet_name):
+            raise StorageError(f"未知の列: {column}")
+        ws = self.worksheet(sheet_name)
+        runs = self._match_runs(sheet_name, column, value)
+        if not runs:
+            return 0
+        # 下の行から削除すれば、同一バッチ内で先に処理したブロックの行番号がずれない
+        runs = sorted(runs, reverse=True)
+        requests = [
+            {"deleteDimension": {"range": {"sheetId": ws.id, "dimension": "ROWS", "startIndex": a - 1, "endIndex": b}}}
+            for a, b in runs
+        ]
+        self.client.call(self.spreadsheet.batch_update, {"requests": requests})
+        with self._index_lock:
+            index = self._indexes.get(sheet_name)
+            if index is not None:
+                for a, b in runs:
+                    index.remove_rows(a, b)
+        return sum(b - a + 1 for a, b in runs)
+
+
+# --- SQLite ---
+
+class SqliteBackend(StorageBackend):
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self.lock = threading.RLock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self._tables = set()
+            for sheet_name in HEADERS:
+                self._create_table(sheet_name)
+
+    def _create_table(self, sheet_name):
+        header = header_for(sheet_name)
+        cols = [f"{header[0]} TEXT PRIMARY KEY"]
+        cols += [f"{c} {'INTEGER' if c in INTEGER_COLUMNS else 'TEXT'}" for c in header[1:]]
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {sheet_name} ({', '.join(cols)})")
+        if index_tag(sheet_name):
+            tag = index_tag(sheet_name)
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{sheet_name}_{tag} ON {sheet_name} ({tag})")
+        self._tables.add(sheet_name)
+
+    def _header(self, sheet_name):
+        # アーカイブパーティションのテーブルは初回利用時に作成する
+        header = header_for(sheet_name)
+        if sheet_name not in self._tables:
+            with self.lock:
+                self._create_table(sheet_name)
+        return header
+
+    def version_marker(self):
+        # 書き込みは WAL に入り、チェックポイントで本体に移るため両方の更新時刻を見る
+        stats = [os.stat(p) for p in (self.path, f"{self.path}-wal") if os.path.exists(p)]
+        return ":".join(f"{st.st_mtime_ns}-{st.st_size}" for st in stats) or None
+
+    def _rows_to_records(self, header, rows):
+        return [{c: ("" if v is None else v) for c, v in zip(header, row)} for row in rows]
+
+    def read_records(self, sheet_name):
+        header = self._header(sheet_name)
+        with self.lock:
+            rows = self.conn.execute(f"SELECT {', '.join(header)} FROM {sheet_name} ORDER BY rowid").fetchall()
+        return self._rows_to_records(header, rows)
+
+    def read_tail(self, sheet_name, offset):
+        header = self._header(sheet_name)
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT {', '.join(header)} FROM {sheet_name} ORDER BY rowid LIMIT -1 OFFSET ?", (offset,)).fetchall()
+        return self._rows_to_records(header, rows)
+
+    def read_trip(self, trip_id, sheet_name="expenses"):
+        header = self._header(sheet_name)
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT {', '.join(header)} FROM {sheet_name} WHERE trip_id = ? ORDER BY rowid", (str(trip_id),)).fetchall()
+        return self._rows_to_records(header, rows)
+
+    def append_rows(self, sheet_name, rows):
+        header = self._header(sheet_name)
+        placeholders = ", ".join("?" * len(header))
+        padded = [list(r) + [""] * (len(header) - len(r)) for r in rows]
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(f"INSERT INTO {sheet_name} ({', '.join(header)}) VALUES ({placeholders})", padded)
+
+    def existing_keys(self, sheet_name, keys):
+        header = self._header(sheet_name)
+        keys = [str(k) for k in keys]
+        found = set()
+        with self.lock:
+            # SQLite のパラメータ数上限に収まるよう分けて問い合わせる
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                found.update(r[0] for r in self.conn.execute(
+                    f"SELECT {header[0]} FROM {sheet_name} WHERE {header[0]} IN ({', '.join('?' * len(chunk))})", chunk))
+        return found
+
+    def update_row(self, sheet_name, key, values):
+        header = self._header(sheet_name)
+        unknown = [c for c in values if c not in header]
+        if unknown:
+            raise StorageError(f"未知の列: {unknown}")
+        assignments = ", ".join(f"{c} = ?" for c in values)
+        with self.lock:
+            cur = self.conn.execute(f"UPDATE {sheet_name} SET {assignments} WHERE {header[0]} = ?", [*values.values(), key])
+        if cur.rowcount == 0:
+            raise StorageError(f"ID '{key}' が見つかりません。")
+
+    def delete_row(self, sheet_name, value, col=1):
+        column = self._header(sheet_name)[col - 1]
+        with self.lock:
+            cur = self.conn.execute(
+                f"DELETE FROM {sheet_name} WHERE rowid = (SELECT rowid FROM {sheet_name} WHERE {column} = ? ORDER BY rowid LIMIT 1)",
+                (value,))
+        if cur.rowcount == 0:
+            raise StorageError(f"ID '{value}' が見つかりません。")
+
+    def delete_where(self, sheet_name, column, value):
+        if column not in self._header(sheet_name):
+            raise StorageError(f"未知の列: {column}")
+        with self.lock:
+            cur = self.conn.execute(f"DELETE FROM {sheet_name} WHERE {column} = ?", (value,))
+        return cur.rowcount
+
+
+# --- インメモリ Fake (テスト・ベンチマーク用) ---
+
+FakeCell = namedtuple("FakeCell", ["row", "col", "value"])
+
+
+# gspread.exceptions.APIError に渡すレスポンスの代わり
+class FakeResponse:
+    def __init__(self, status_code, message):
+        self.status_code = status_code
+        self.text = message
+        self.headers = {}
+
+    def json(self):
+        return {"error": {"code": self.status_code, "message": self.text, "status": "RESOURCE_EXHAUSTED"}}
+
+
+def _inject_faults(target, write):
+    # 呼び出し 1 回分の遅延と、error_rate の確率でのクォータ超過 (429) を模す
+    target.calls += 1
+    if target.latency:
+        time.sleep(target.latency)
+    if target.error_rate and target.rng.random() < target.error_rate:
+        raise gspread.exceptions.APIError(FakeResponse(429, "Quota exceeded (fake)"))
+    target.writes += write
+
+
+# gspread.Worksheet の一部を模したインメモリ実装。
+# 呼び出し毎に latency 秒の遅延と、error_rate の確率での 429 エラーを注入できる。
+class FakeWorksheet:
+    def __init__(self, title, header=None, latency=0.0, sheet_id=0, error_rate=0.0, rng=None):
+        self.title = title
+        self.id = sheet_id
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = rng or random.Random(0)
+        self.calls = 0
+        self.writes = 0
+        self._rows = [list(header)] if header else []
+
+    def _tick(self, write=False):
+        _inject_faults(self, write)
+
+    def get_all_values(self):
+        self._tick()
+        return [list(r) for r in self._rows]
+
+    def get_all_records(self):
+        self._tick()
+        if not self._rows:
+            return []
+        return _values_to_records(self._rows[0], self._rows[1:])
+
+    def get_values(self, range_name=None, **kwargs):
+        self._tick()
+        if range_name is None:
+            return [list(r) for r in self._rows]
+        return self._read_range(range_name)
+
+    def _append_response(self, start_row, count):
+        end_row = start_row + count - 1
+        return {"updates": {"updatedRange": f"{self.title}!A{start_row}:{col_letter(len(self._rows[0]) if self._rows else 1)}{end_row}"}}
+
+    def append_row(self, values, **kwargs):
+        self._tick(write=True)
+        self._rows.append(list(values))
+        return self._append_response(len(self._rows), 1)
+
+    def append_rows(self, values, **kwargs):
+        self._tick(write=True)
+        start_row = len(self._rows) + 1
+        self._rows.extend(list(v) for v in values)
+        return self._append_response(start_row, len(values))
+
+    def _read_range(self, range_name):
+        start, _, end = range_name.partition(":")
+        row, col = parse_a1(start)
+        if not end:
+            end_row, end_col = row, col
+        elif end[-1].isdigit():
+            end_row, end_col = parse_a1(end)
+        else:
+            # "A2:A" のような下端なしの範囲
+            end_row, end_col = len(self._rows), parse_a1(f"{end}1")[1]
+        return [
+            [v for v in self._rows[r - 1][col - 1:end_col]]
+            for r in range(row, min(end_row, len(self._rows)) + 1)
+        ]
+
+    def batch_get(self, ranges, **kwargs):
+        self._tick()
+        return [self._read_range(r) for r in ranges]
+
+    def col_values(self, col):
+        self._tick()
+        return [row[col - 1] if col - 1 < len(row) else "" for row in self._rows]
+
+    def cell(self, row, col):
+        self._tick()
+        target = self._rows[row - 1] if row - 1 < len(self._rows) else []
+        return FakeCell(row, col, target[col - 1] if col - 1 < len(target) else "")
+
+    def find(self, query, in_column=None):
+        self._tick()
+        for r, row in enumerate(self._rows, start=1):
+            cols = [in_column - 1] if in_column else range(len(row))
+            for c in cols:
+                if c < len(row) and str(row[c]) == str(query):
+                    return FakeCell(r, c + 1, row[c])
+        return None
+
+    def update_cell(self, row, col, value):
+        self._tick(write=True)
+        target = self._rows[row - 1]
+        target.extend([""] * (col - len(target)))
+        target[col - 1] = value
+
+    def _write_range(self, range_name, values):
+        start, _, _ = range_name.partition(":")
+        row, col = parse_a1(start)
+        for r_off, vals in enumerate(values):
+            while len(self._rows) < row + r_off:
+                self._rows.append([])
+            target = self._rows[row + r_off - 1]
+            target.extend([""] * (col - 1 + len(vals) - len(target)))
+            target[col - 1:col - 1 + len(vals)] = vals
+
+    def update(self, range_name=None, values=None, **kwargs):
+        self._tick(write=True)
+        self._write_range(range_name, values)
+
+    def batch_update(self, data, **kwargs):
+        self._tick(write=True)
+        for item in data:
+            self._write_range(item["range"], item["values"])
+
+    def delete_rows(self, start_index, end_index=None):
+        self._tick(write=True)
+        end_index = end_index or start_index
+        del self._rows[start_index - 1:end_index]
+
+    def clear(self):
+        self._tick(write=True)
+        self._rows = []
+
+
+class FakeSpreadsheet:
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.writes = 0
+        self._sheets = {
+            name: FakeWorksheet(name, header, latency, sheet_id=i, error_rate=error_rate, rng=self.rng)
+            for i, (name, header) in enumerate(HEADERS.items())
+        }
+
+    def set_faults(self, latency=0.0, error_rate=0.0):
+        for target in [self, *self._sheets.values()]:
+            target.latency = latency
+            target.error_rate = error_rate
+
+    def seed_rows(self, title, rows):
+        # ベンチマーク用: API 呼び出しとして数えずに行を投入する
+        self._sheets[title]._rows.extend(list(r) for r in rows)
+
+    def worksheet(self, title):
+        if title not in self._sheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self._sheets[title]
+
+    def add_worksheet(self, title, rows=1000, cols=26):
+        _inject_faults(self, True)
+        ws = FakeWorksheet(title, latency=self.latency, sheet_id=max(w.id for w in self._sheets.values()) + 1,
+                           error_rate=self.error_rate, rng=self.rng)
+        self._sheets[title] = ws
+        return ws
+
+    def get_lastUpdateTime(self):
+        # Drive の modifiedTime の代わりに書き込み回数を返す
+        _inject_faults(self, False)
+        return str(self.writes + sum(ws.writes for ws in self._sheets.values()))
+
+    def batch_update(self, body):
+        # deleteDimension (行削除) のみ対応
+        _inject_faults(self, True)
+        by_id = {ws.id: ws for ws in self._sheets.values()}
+        for req in body.get("requests", []):
+            rng = req["deleteDimension"]["range"]
+            ws = by_id[rng["sheetId"]]
+            del ws._rows[rng["startIndex"]:rng["endIndex"]]
+        return {"replies": [{} for _ in body.get("requests", [])]}
+
+    @property
+    def total_calls(self):
+        return self.calls + sum(ws.calls for ws in self._sheets.values())
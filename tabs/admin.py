@@ -1,10 +1,13 @@
 import streamlit as st
+import pandas as pd
+import json
 from datetime import datetime
 import utils
+from metrics import METRICS
 
 def render():
     st.header("プロジェクト管理センター")
-    tab1, tab2, tab3, tab4 = st.tabs(["新規旅行登録", "データ修正(Edit)", "旅行修正(Trips)", "データ削除"])
+    tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(["新規旅行登録", "データ修正(Edit)", "旅行修正(Trips)", "データ削除", "一括取込(Import)", "診断(Diagnostics)"])
     
     with tab1:
         with st.form("new_trip_form"):
@@ -20,20 +23,16 @@ def render():
     with tab2:
         st.subheader("既存データの修正")
         df_trips = utils.load_cached_data("trips")
-        df_ex = utils.load_cached_data("expenses")
-        if not df_trips.empty and not df_ex.empty:
+        if not df_trips.empty:
             t_dict = df_trips.set_index('trip_id')['trip_name'].to_dict()
             sel_t_id = st.selectbox("修正対象の旅行", list(t_dict.keys()), format_func=lambda x: str(t_dict[x]), key="edit_trip_sel")
-            trip_expenses = df_ex[df_ex['trip_id'] == sel_t_id].copy()
+            trip_expenses = utils.load_trip_expenses(sel_t_id)
             
             if not trip_expenses.empty:
-                if 'expense_date' not in trip_expenses.columns:
-                     trip_expenses['expense_date'] = trip_expenses['timestamp'].astype(str).str.split(" ").str[0]
-                
-                trip_expenses['expense_date'] = trip_expenses['expense_date'].astype(str)
-                trip_expenses['item_name'] = trip_expenses['item_name'].fillna('').astype(str)
-                trip_expenses['amount'] = trip_expenses['amount'].fillna(0).astype(str)
-                trip_expenses['label'] = trip_expenses['expense_date'] + " - " + trip_expenses['item_name'] + " (¥" + trip_expenses['amount'] + ")"
+                trip_expenses['label'] = (
+                    trip_expenses['expense_date'].dt.strftime("%Y-%m-%d").fillna("") + " - " + trip_expenses['item_name']
+                    + " (¥" + trip_expenses['amount'].astype(str) + ")"
+                )
                 
                 exp_dict = trip_expenses.set_index('entry_id')['label'].to_dict()
                 sel_exp_id = st.selectbox("修正項目", list(exp_dict.keys()), format_func=lambda x: exp_dict[x])
@@ -41,19 +40,18 @@ def render():
                 
                 st.markdown("---")
                 with st.form("edit_form"):
-                    try: curr_date = datetime.strptime(str(target_row['expense_date']), "%Y-%m-%d").date()
-                    except: curr_date = datetime.today()
+                    curr_date = target_row['expense_date'].date() if pd.notna(target_row['expense_date']) else datetime.today()
                     new_date = st.date_input("支出日", value=curr_date)
                     new_item = st.text_input("品目・店名", value=target_row['item_name'])
                     c1, c2 = st.columns(2)
-                    new_amount = c1.number_input("金額", min_value=0, value=int(float(target_row['amount'])), step=100)
-                    curr_cat = target_row['category']
+                    new_amount = c1.number_input("金額", min_value=0, value=int(target_row['amount']), step=100)
+                    curr_cat = str(target_row['category'])
                     cat_opts = ["食事", "宿泊", "交通", "娯楽/体験", "雑費"]
                     cat_idx = cat_opts.index(curr_cat) if curr_cat in cat_opts else 0
                     new_cat = c2.selectbox("カテゴリ", cat_opts, index=cat_idx)
                     
                     st.markdown("---")
-                    curr_sat = int(float(target_row['satisfaction']))
+                    curr_sat = int(target_row['satisfaction'])
                     is_currently_pending = (curr_sat == 0)
                     new_is_pending = st.checkbox("未評価 (Pending) に設定する", value=is_currently_pending)
                     
@@ -64,25 +62,24 @@ def render():
                         default_sat = 5 if is_currently_pending else curr_sat
                         new_sat = st.slider("満足度", 1, 10, default_sat)
 
-                    curr_waste_val = str(target_row.get('is_waste', 'FALSE')).upper() == 'TRUE'
+                    curr_waste_val = bool(target_row['is_waste'])
                     new_waste = st.checkbox("浪費 (Avoidable Waste)", value=curr_waste_val)
                     new_detail = st.text_area("詳細", value=target_row['detail'])
                     
                     if st.form_submit_button("修正保存"):
-                        utils.update_expense(sel_exp_id, new_cat, new_item, new_amount, new_sat, new_detail, new_date, new_waste)
+                        utils.update_expense(sel_exp_id, new_cat, new_item, new_amount, new_sat, new_detail, new_date, new_waste, sheet_name=utils.expense_sheet(sel_t_id))
             else: st.info("データがありません")
 
     with tab3:
         st.subheader("旅行情報の修正")
         df_trips = utils.load_cached_data("trips")
         if not df_trips.empty:
-            if 'detail' not in df_trips.columns: df_trips['detail'] = ""
             t_dict = df_trips.set_index('trip_id').T.to_dict()
             sel_t_id = st.selectbox("修正する旅行を選択", list(t_dict.keys()), format_func=lambda x: f"{t_dict[x]['trip_name']} ({t_dict[x]['status']})", key="mod_trip_sel")
             curr_data = t_dict[sel_t_id]
             with st.form("mod_trip_form"):
                 m_name = st.text_input("旅行名", value=curr_data['trip_name'])
-                m_budget = st.number_input("総予算", min_value=0, step=10000, value=int(str(curr_data['total_budget']).replace(',','')) if curr_data['total_budget'] else 0)
+                m_budget = st.number_input("総予算", min_value=0, step=10000, value=int(curr_data['total_budget']))
                 c1, c2 = st.columns(2)
                 try: d_start = datetime.strptime(str(curr_data['start_date']), "%Y-%m-%d").date()
                 except: d_start = datetime.today()
@@ -98,6 +95,14 @@ def render():
                 if st.form_submit_button("旅行情報を更新"):
                     utils.update_trip_info(sel_t_id, m_name, m_start, m_end, m_budget, m_status, m_detail)
 
+            st.markdown("---")
+            st.subheader("アーカイブ")
+            archived = utils.archived_trip_ids()
+            finished = df_trips[df_trips['status'].isin(utils.ARCHIVE_STATUSES) & ~df_trips['trip_id'].isin(archived)]
+            st.caption(f"アーカイブ済み {len(archived)} 件 / 未アーカイブの完了・中止 {len(finished)} 件 (完了・中止にすると自動でアーカイブされます)")
+            if st.button("完了・中止済みの旅行をアーカイブ", disabled=finished.empty):
+                utils.archive_finished_trips()
+
     with tab4:
         st.subheader("データ削除")
         del_type = st.radio("削除対象", ["支出データ (1件)", "旅行プロジェクト (全体)"], horizontal=True)
@@ -115,4 +120,79 @@ def render():
                 confirm_name = st.text_input(f"確認のため「{target_name}」と入力してください")
                 if st.button("プロジェクト完全抹消"):
                     if confirm_name == target_name: utils.delete_trip_cascade(del_trip_id, target_name)
-                    else: st.error("名前不一致")
\ No newline at end of file
+                    else: st.error("名前不一致")
+
+    with tab5:
+        st.subheader("支出の一括取り込み (CSV)")
+        st.caption("エクスポートした CSV や、カード明細 (利用日・利用店名・利用金額 等) を取り込めます。"
+                   "同じ内容の行は重複として飛ばすため、途中で失敗した場合は同じファイルを再度取り込めば未反映の行だけが書き込まれます。")
+        df_trips = utils.load_cached_data("trips")
+        if not df_trips.empty:
+            imp_opts = {"": "CSV の trip_id 列に従う", **df_trips.set_index('trip_id')['trip_name'].to_dict()}
+            imp_trip = st.selectbox("取り込み先の旅行", list(imp_opts.keys()), format_func=lambda x: str(imp_opts[x]), key="import_trip_sel")
+            upload = st.file_uploader("CSV ファイル", type="csv")
+            if upload is not None and st.button("取り込み開始"):
+                bar = st.progress(0.0, text="検証中...")
+                result = utils.import_expenses(
+                    upload, imp_trip or None,
+                    lambda r: bar.progress(min(upload.tell() / max(upload.size, 1), 1.0), text=f"検証中... {r['read']:,} 行"))
+                pending, failed = utils.wait_for_sync(
+                    result["op_ids"], lambda done, total: bar.progress(done / total if total else 1.0, text=f"書き込み中... {done}/{total} バッチ"))
+                rejected = result["rejected"]
+                st.success(f"{result['queued']:,} 件を登録しました (読み込み {result['read']:,} 行 / 重複 {result['duplicates']:,} 件 / 不正 {len(rejected):,} 件)")
+                if pending: st.info(f"残り {pending} バッチはバックグラウンドで同期を続けます。")
+                if failed: st.error(f"{failed} バッチの書き込みに失敗しました。同じファイルを再度取り込むと、未反映の行だけが書き込まれます。")
+                if not rejected.empty:
+                    st.dataframe(rejected.head(100), use_container_width=True)
+                    st.download_button("不正行をダウンロード", data=rejected.to_csv(index=False).encode('utf-8-sig'), file_name="import_rejected.csv", mime='text/csv')
+
+    with tab6:
+        render_diagnostics()
+
+def render_diagnostics():
+    st.subheader("パフォーマンス診断")
+    diag = utils.diagnostics()
+    st.caption(f"計測開始: {datetime.fromtimestamp(diag['since']).strftime('%Y-%m-%d %H:%M:%S')} / バックエンド: {diag['backend']}")
+
+    counters = diag["counters"]
+    quota = diag["quota"]
+    c1, c2, c3, c4 = st.columns(4)
+    c1.metric("API 呼び出し", f"{quota.get('calls', 0):,}")
+    c2.metric("再試行", f"{quota.get('retries', 0):,}")
+    c3.metric("同期待ち / 失敗", f"{diag['queue']['pending']} / {diag['queue']['failed']}")
+    c4.metric("受信 / 送信", f"{counters.get('bytes.received', 0) / 1e6:.1f} / {counters.get('bytes.sent', 0) / 1e6:.1f} MB")
+
+    st.markdown("##### 処理時間 (ms)")
+    timings = pd.DataFrame.from_dict(diag["timings"], orient="index")
+    if not timings.empty:
+        for col in ["total", "p50", "p95", "max"]:
+            timings[col] = timings[col] * 1000
+        st.dataframe(timings.sort_values("total", ascending=False).round(1), use_container_width=True)
+    else: st.info("まだ計測データがありません")
+
+    st.markdown("##### キャッシュ")
+    cache_stats = pd.Series({k[len("cache."):]: v for k, v in counters.items() if k.startswith("cache.")}, dtype="int64")
+    if not cache_stats.empty:
+        split = cache_stats.index.str.rsplit(".", n=1)
+        hits = cache_stats.groupby([split.str[0], split.str[1]]).sum().unstack(fill_value=0)
+        st.dataframe(hits, use_container_width=True)
+    st.dataframe(pd.DataFrame.from_dict(diag["caches"], orient="index"), use_container_width=True)
+
+    dump = json.dumps(diag, ensure_ascii=False, indent=2)
+    c1, c2, c3 = st.columns(3)
+    c1.download_button("JSON をダウンロード", data=dump.encode("utf-8"), file_name="diagnostics.json", mime="application/json")
+    if c2.button("計測をリセット"):
+        METRICS.reset()
+        st.rerun()
+    # ボタンを押した実行ではなく、その次の再実行 (ページ切替・入力等) を計測する
+    if c3.button("次の再実行をプロファイル"):
+        st.session_state["_profile_next"] = True
+        st.info("次の操作 (ページ切替・入力等) の再実行を cProfile で計測します。")
+    with st.expander("JSON"):
+        st.json(diag)
+
+    report = st.session_state.get("_profile_report")
+    if report and "text" in report:
+        st.markdown(f"##### プロファイル ({report['page']} / {datetime.fromtimestamp(report['at']).strftime('%H:%M:%S')})")
+        st.code(report["text"], language=None)
+        st.download_button("プロファイル (.prof) をダウンロード", data=report["raw"], file_name=f"profile_{report['page']}.prof", mime="application/octet-stream")
@@ -1,18 +1,231 @@
 import streamlit as st
 import plotly.graph_objects as go
-import plotly.express as px
+from plotly.colors import qualitative
 from datetime import datetime
+import numpy as np
 import pandas as pd
 import utils
+import export
+from metrics import METRICS
 
-def highlight_audit_rows(row):
-    is_waste = str(row.get('is_waste', '')).upper() == 'TRUE'
-    try: sat = int(row.get('satisfaction', 0))
-    except: sat = 0
-    if is_waste: return ['background-color: #FFD700; color: black'] * len(row)
-    elif sat == 0: return ['background-color: #7f8c8d; color: white'] * len(row)
-    elif sat <= 3: return ['background-color: #ff6347; color: white'] * len(row)
-    return [''] * len(row)
+ROW_STYLES = {
+    "waste": f"background-color: {utils.COLOR_GOLD}; color: black",
+    "pending": f"background-color: {utils.COLOR_GREY}; color: white",
+    "low": f"background-color: {utils.COLOR_TOMATO}; color: white",
+    "": "",
+}
+DISPLAY_COLS = ['expense_date', 'category', 'item_name', 'amount', 'satisfaction', 'is_waste', 'detail', 'entry_id']
+PAGE_SIZES = [50, 100, 200, 500]
+WASTE_FILTERS = ["すべて", "浪費のみ", "浪費以外"]
+CATEGORY_ORDER = ["食事", "宿泊", "交通", "娯楽/体験", "雑費"]
+
+def audit_row_classes(df):
+    # 優先順位: 浪費 > 未評価 > 低満足度 (<=3)
+    return pd.Series(
+        np.select([df['is_waste'], df['satisfaction'] == 0, df['satisfaction'] <= 3], ["waste", "pending", "low"], default=""),
+        index=df.index,
+    )
+
+def style_audit_rows(df):
+    # 行ごとの Python 呼び出しを避け、表示ページ分のスタイル表をまとめて生成する
+    styles = audit_row_classes(df).map(ROW_STYLES).to_numpy()
+    return pd.DataFrame(np.repeat(styles[:, None], len(df.columns), axis=1), index=df.index, columns=df.columns)
+
+def filter_ledger(df, categories=None, waste="すべて", date_range=None, sat_range=None):
+    mask = pd.Series(True, index=df.index)
+    if categories:
+        mask &= df['category'].isin(categories)
+    if waste == "浪費のみ":
+        mask &= df['is_waste']
+    elif waste == "浪費以外":
+        mask &= ~df['is_waste']
+    if date_range:
+        start, end = date_range
+        mask &= df['expense_date'].between(pd.Timestamp(start), pd.Timestamp(end))
+    if sat_range:
+        mask &= df['satisfaction'].between(*sat_range)
+    return df[mask]
+
+def ledger_page(df, page, page_size):
+    ordered = df.sort_values(['expense_date', 'timestamp'], ascending=False, kind='stable')
+    start = (page - 1) * page_size
+    return ordered.iloc[start:start + page_size]
+
+def budget_figure(total_spent, budget):
+    ratio = (total_spent / budget) * 100
+    bar_color = utils.COLOR_RED if total_spent > budget else utils.COLOR_GREEN
+    fig_budget = go.Figure()
+    fig_budget.add_trace(go.Bar(
+        x=[total_spent], y=[""], orientation='h', marker=dict(color=bar_color),
+        text=[f"{int(ratio)}%"], textposition='inside', insidetextanchor='middle',
+        textfont=dict(size=60, color='white', family="Arial Black")
+    ))
+    max_x = max(budget, total_spent) * 1.05
+    fig_budget.update_layout(
+        title="予算消化状況", xaxis=dict(range=[0, max_x], title=f"{total_spent:,}円 / {budget:,}円", tickfont=dict(size=14), title_font=dict(size=18)),
+        yaxis=dict(showticklabels=False), height=200, margin=dict(l=20, r=20, t=40, b=40)
+    )
+    fig_budget.add_vline(x=budget, line_width=3, line_dash="dash", line_color="white", annotation_text="Budget")
+    return fig_budget
+
+def category_figure(by_category, total_spent):
+    # 集計済みのカテゴリ別合計から作る。ラベルと色は列演算でまとめて生成する
+    cat_sum = pd.Series(by_category, dtype="int64").reindex(CATEGORY_ORDER).dropna()
+    cat_sum = cat_sum[cat_sum != 0].astype("int64")
+    percent = (cat_sum / total_spent * 100).round(1)
+    labels = cat_sum.index + " (" + percent.astype(str) + "%)"
+    colors = cat_sum.index.map(lambda c: utils.CATEGORY_COLOR_MAP.get(c, "#808080"))
+    fig_cat = go.Figure(go.Pie(
+        labels=list(labels), values=cat_sum.tolist(), hole=0.6, marker=dict(colors=list(colors)),
+        textinfo='none', sort=False, direction='clockwise'
+    ))
+    fig_cat.update_layout(
+        title="カテゴリ別内訳", annotations=[dict(text=f"¥{total_spent:,}", x=0.5, y=0.5, font_size=24, showarrow=False, font_weight="bold")],
+        height=250, margin=dict(l=20, r=20, t=40, b=20), showlegend=True, legend=dict(font=dict(size=14))
+    )
+    return fig_cat
+
+@METRICS.timed("audit.export")
+def render_export(df_ex, df_trips, bundle_allowed):
+    # ファイルはボタンが押された時にだけ生成する (描画の度に台帳全体を文字列化しない)
+    c1, c2, c3 = st.columns([1, 1, 2])
+    fmt = c1.selectbox("形式", export.available_formats(), label_visibility="collapsed")
+    bundle = bundle_allowed and c2.checkbox("旅行毎に zip", help="旅行毎の支出ファイルと旅行一覧をまとめます (アーカイブ済みを含む)")
+    stamp = datetime.now().strftime("%Y%m%d")
+    if bundle:
+        data = lambda: export.export_bundle(df_trips, utils.iter_trip_expenses(df_trips), fmt)
+        file_name, mime, label = f"travel_audit_{stamp}.zip", "application/zip", "zipエクスポート"
+    else:
+        ext, mime = export.FORMATS[fmt]
+        data = lambda: export.export_file(df_ex, fmt)
+        file_name, label = f"travel_audit_{stamp}.{ext}", f"{fmt}エクスポート"
+    c3.download_button(label=label, data=data, file_name=file_name, mime=mime, on_click="ignore")
+
+@METRICS.timed("audit.ledger")
+def render_ledger(df_ex):
+    with st.expander("🔍 絞り込み"):
+        f1, f2 = st.columns(2)
+        sel_cats = f1.multiselect("カテゴリ", list(df_ex['category'].cat.categories))
+        sel_waste = f2.radio("浪費", WASTE_FILTERS, horizontal=True)
+        dates = df_ex['expense_date'].dropna()
+        date_range = None
+        if not dates.empty:
+            d_min, d_max = dates.min().date(), dates.max().date()
+            picked = f1.date_input("支出日の範囲", value=(d_min, d_max), min_value=d_min, max_value=d_max)
+            if isinstance(picked, tuple) and len(picked) == 2 and picked != (d_min, d_max):
+                date_range = picked
+        sat_range = f2.slider("満足度 (0 = 未評価)", 0, 10, (0, 10))
+    filtered = filter_ledger(df_ex, sel_cats, sel_waste, date_range, None if sat_range == (0, 10) else sat_range)
+
+    total = len(filtered)
+    p1, p2 = st.columns([1, 3])
+    page_size = p1.selectbox("表示件数", PAGE_SIZES, index=1)
+    pages = max(1, -(-total // page_size))
+    page = p2.number_input(f"ページ (全 {pages})", min_value=1, max_value=pages, value=1, step=1)
+    page_df = ledger_page(filtered, page, page_size)
+    first = (page - 1) * page_size + 1 if total else 0
+    st.caption(f"{total:,} 件中 {first:,}–{first + len(page_df) - 1 if total else 0:,} 件を表示")
+
+    valid_cols = [c for c in DISPLAY_COLS if c in page_df.columns]
+    view = page_df[valid_cols].copy()
+    # 書き込みキューで未送信の行は「同期中」と表示する (楽観的表示)
+    syncing = view['entry_id'].isin(utils.pending_keys("expenses"))
+    view.insert(0, 'sync', np.where(syncing, "⏳ 同期中", ""))
+    st.dataframe(
+        view.style.apply(style_audit_rows, axis=None), use_container_width=True, hide_index=True,
+        column_config={
+            "sync": st.column_config.TextColumn("", width="small"),
+            "expense_date": st.column_config.DateColumn("expense_date", format="YYYY-MM-DD"),
+        },
+    )
+
+def burn_figure(daily, summary, trip_ids):
+    # 選択した旅行の累計支出 (実線) と予算線 (破線、開始日 0 円 → 終了日に総予算)
+    fig = go.Figure()
+    palette = qualitative.Plotly
+    daily = daily[daily['trip_id'].isin(trip_ids)]
+    lines = dict(tuple(daily.groupby('trip_id')))
+    for i, trip_id in enumerate(trip_ids):
+        info = summary.loc[trip_id]
+        color = palette[i % len(palette)]
+        if trip_id in lines:
+            line = lines[trip_id]
+            fig.add_trace(go.Scatter(x=line['expense_date'], y=line['cumulative'], mode='lines+markers', name=str(info['trip_name']), line=dict(color=color)))
+        if pd.notna(info['days']):
+            fig.add_trace(go.Scatter(
+                x=[info['start'], info['end']], y=[0, info['budget']], mode='lines', name=f"{info['trip_name']} 予算",
+                line=dict(color=color, dash='dash'), showlegend=False, hoverinfo='skip'
+            ))
+    fig.update_layout(title="累計支出と予算線", yaxis=dict(title="円"), height=350, margin=dict(l=20, r=20, t=40, b=20))
+    return fig
+
+def mix_figure(mix, summary, trip_ids):
+    # 選択した旅行のカテゴリ構成比 (100% 積み上げ)
+    shares = mix.reindex(trip_ids).fillna(0) * 100
+    names = summary['trip_name'].reindex(trip_ids).astype(str)
+    fig = go.Figure([
+        go.Bar(y=names, x=shares[cat], name=cat, orientation='h', marker=dict(color=utils.CATEGORY_COLOR_MAP.get(cat, "#808080")))
+        for cat in shares.columns
+    ])
+    fig.update_layout(title="カテゴリ構成比", barmode='stack', xaxis=dict(title="%", range=[0, 100]), height=350, margin=dict(l=20, r=20, t=40, b=20))
+    return fig
+
+def value_figure(summary):
+    # 全旅行の浪費率と満足度/千円 (円の大きさは支出額)
+    rated = summary[summary['satisfaction_per_1k'].notna()]
+    size = np.sqrt(rated['spent'] / rated['spent'].max()) * 40 + 5 if not rated.empty else []
+    fig = go.Figure(go.Scatter(
+        x=rated['waste_ratio'] * 100, y=rated['satisfaction_per_1k'], mode='markers', text=rated['trip_name'],
+        marker=dict(size=size, color=utils.COLOR_CYAN, opacity=0.6),
+        hovertemplate="%{text}<br>浪費率 %{x:.1f}%<br>満足度/千円 %{y:.2f}<extra></extra>"
+    ))
+    fig.update_layout(title="浪費率と満足度/千円", xaxis=dict(title="浪費率 (%)"), yaxis=dict(title="満足度 / 千円"), height=350, margin=dict(l=20, r=20, t=40, b=20))
+    return fig
+
+@METRICS.timed("audit.analytics")
+def render_analytics():
+    st.markdown("### 📈 旅行横断分析")
+    result = utils.get_analytics()
+    summary = result['summary']
+    trips = summary[summary['count'] > 0]
+    if trips.empty:
+        return
+
+    kpi1, kpi2, kpi3, kpi4 = st.columns(4)
+    kpi1.metric("旅行数", f"{len(trips):,}")
+    kpi2.metric("予算超過見込み", f"{int((trips['overrun'] > 0).sum()):,} 件")
+    kpi3.metric("浪費率 (全体)", f"{trips['waste'].sum() / max(trips['spent'].sum(), 1):.1%}")
+    kpi4.metric("満足度 / 千円 (全体)", f"{trips['rated_sat'].sum() * 1000 / max(trips['rated_amount'].sum(), 1):.2f}")
+
+    # 既定では超過見込みの大きい旅行を比較する
+    names = trips['trip_name'].astype(str).to_dict()
+    default = list(trips.sort_values('overrun', ascending=False).index[:5])
+    selected = st.multiselect("比較する旅行", list(trips.index), default=default, format_func=lambda x: names[x], key="analytics_trips")
+    if selected:
+        col_g1, col_g2 = st.columns(2)
+        with col_g1:
+            st.plotly_chart(utils.ledger_figure("burn", tuple(selected), result['version'], lambda: burn_figure(result['daily'], summary, selected)), use_container_width=True)
+        with col_g2:
+            st.plotly_chart(utils.ledger_figure("mix", tuple(selected), result['version'], lambda: mix_figure(result['mix'], summary, selected)), use_container_width=True)
+    st.plotly_chart(utils.ledger_figure("value", (), result['version'], lambda: value_figure(trips)), use_container_width=True)
+
+    table = trips[['trip_name', 'status', 'budget', 'spent', 'projected', 'overrun', 'waste_ratio', 'satisfaction_per_1k']].assign(
+        waste_ratio=trips['waste_ratio'] * 100)
+    table = table.join(result['mix'] * 100)
+    pct = {cat: st.column_config.NumberColumn(cat, format="%.1f%%") for cat in result['mix'].columns}
+    st.dataframe(
+        table.sort_values('overrun', ascending=False), use_container_width=True, hide_index=True,
+        column_config={
+            "trip_name": "旅行名", "status": "ステータス",
+            "budget": st.column_config.NumberColumn("予算", format="¥%d"),
+            "spent": st.column_config.NumberColumn("支出", format="¥%d"),
+            "projected": st.column_config.NumberColumn("着地見込み", format="¥%d"),
+            "overrun": st.column_config.NumberColumn("超過見込み", format="¥%d"),
+            "waste_ratio": st.column_config.NumberColumn("浪費率", format="%.1f%%"),
+            "satisfaction_per_1k": st.column_config.NumberColumn("満足度/千円", format="%.2f"),
+            **pct,
+        },
+    )
 
 def render():
     st.header("データ監査・分析")
@@ -23,88 +236,45 @@ def render():
         filter_opts = ["ALL"] + list(trip_options.keys())
         target_trip = st.selectbox("フィルタ", filter_opts, format_func=lambda x: str(trip_options.get(x, "全プロジェクト")))
         
-        df_ex = utils.load_cached_data("expenses")
+        # 全件を読むのは ALL 表示の時だけ (アーカイブ済みの旅行を含む)。個別の旅行は対象行だけを取得する
+        if target_trip == "ALL":
+            df_ex, _ = utils.load_ledger()
+        else:
+            df_ex = utils.load_trip_expenses(target_trip)
         
         if not df_ex.empty:
-            if 'expense_date' not in df_ex.columns: df_ex['expense_date'] = ""
-            if 'is_waste' not in df_ex.columns: df_ex['is_waste'] = "FALSE"
-            
-            for idx, row in df_ex.iterrows():
-                if str(row['expense_date']).strip() == "":
-                    ts_val = str(row.get('timestamp', ''))
-                    if ts_val:
-                        try: df_ex.at[idx, 'expense_date'] = ts_val.split(" ")[0]
-                        except: pass
-
             if target_trip != "ALL":
-                df_ex = df_ex[df_ex['trip_id'] == target_trip]
-                
                 st.markdown("### 📊 支出分析")
                 budget_row = df_trips[df_trips['trip_id'] == target_trip]
-                budget_val = budget_row['total_budget'].iloc[0]
-                budget = int(budget_val) if not budget_row.empty and budget_val else 1
-                total_spent = int(df_ex['amount'].sum())
-                waste_df = df_ex[df_ex['is_waste'].astype(str).str.upper() == "TRUE"]
-                total_waste = int(waste_df['amount'].sum())
+                budget_val = int(budget_row['total_budget'].iloc[0]) if not budget_row.empty else 0
+                budget = budget_val if budget_val else 1
+                rollup = utils.get_trip_rollup(target_trip)
+                total_spent = rollup.total
+                total_waste = rollup.waste
                 
-                kpi1, kpi2, kpi3 = st.columns(3)
+                kpi1, kpi2, kpi3, kpi4 = st.columns(4)
                 kpi1.metric("総支出", f"¥{total_spent:,}")
                 kpi2.metric("予算残", f"¥{budget - total_spent:,}")
                 kpi3.metric("総浪費額 (Waste)", f"¥{total_waste:,}", delta=-total_waste, delta_color="inverse")
+                kpi4.metric("未評価 (Pending)", f"{rollup.pending:,} 件")
                 
                 col_g1, col_g2 = st.columns(2)
                 
                 with col_g1:
-                    ratio = (total_spent / budget) * 100
-                    bar_color = utils.COLOR_RED if total_spent > budget else utils.COLOR_GREEN
-                    fig_budget = go.Figure()
-                    fig_budget.add_trace(go.Bar(
-                        x=[total_spent], y=[""], orientation='h', marker=dict(color=bar_color),
-                        text=[f"{int(ratio)}%"], textposition='inside', insidetextanchor='middle',
-                        textfont=dict(size=60, color='white', family="Arial Black")
-                    ))
-                    max_x = max(budget, total_spent) * 1.05
-                    fig_budget.update_layout(
-                        title="予算消化状況", xaxis=dict(range=[0, max_x], title=f"{total_spent:,}円 / {budget:,}円", tickfont=dict(size=14), title_font=dict(size=18)),
-                        yaxis=dict(showticklabels=False), height=200, margin=dict(l=20, r=20, t=40, b=40)
-                    )
-                    fig_budget.add_vline(x=budget, line_width=3, line_dash="dash", line_color="white", annotation_text="Budget")
+                    fig_budget = utils.trip_figure("budget", target_trip, lambda: budget_figure(total_spent, budget))
                     st.plotly_chart(fig_budget, use_container_width=True)
 
                 with col_g2:
                     if total_spent > 0:
-                        cat_sum = df_ex.groupby('category')['amount'].sum().reset_index()
-                        fixed_order = ["食事", "宿泊", "交通", "娯楽/体験", "雑費"]
-                        cat_sum['category'] = pd.Categorical(cat_sum['category'], categories=fixed_order, ordered=True)
-                        cat_sum = cat_sum.sort_values('category')
-                        
-                        cat_sum['percent'] = (cat_sum['amount'] / total_spent) * 100
-                        cat_sum['label'] = cat_sum.apply(lambda x: f"{x['category']} ({x['percent']:.1f}%)", axis=1)
-                        
-                        chart_color_map = {}
-                        for _, row in cat_sum.iterrows():
-                            cat_name = str(row['category'])
-                            label_name = row['label']
-                            chart_color_map[label_name] = utils.CATEGORY_COLOR_MAP.get(cat_name, "#808080")
-
-                        fig_cat = px.pie(
-                            cat_sum, values='amount', names='label', hole=0.6,
-                            color='label', color_discrete_map=chart_color_map
-                        )
-                        fig_cat.update_traces(textinfo='none', sort=False, direction='clockwise')
-                        fig_cat.update_layout(
-                            title="カテゴリ別内訳", annotations=[dict(text=f"¥{total_spent:,}", x=0.5, y=0.5, font_size=24, showarrow=False, font_weight="bold")],
-                            height=250, margin=dict(l=20, r=20, t=40, b=20), showlegend=True, legend=dict(font=dict(size=14))
-                        )
+                        by_category = dict(rollup.by_category)
+                        fig_cat = utils.trip_figure("category", target_trip, lambda: category_figure(by_category, total_spent))
                         st.plotly_chart(fig_cat, use_container_width=True)
+            else:
+                render_analytics()
 
             st.markdown("### 📝 支出明細")
-            csv = df_ex.to_csv(index=False).encode('utf-8-sig')
-            st.download_button(label="CSVエクスポート", data=csv, file_name=f'travel_audit_{datetime.now().strftime("%Y%m%d")}.csv', mime='text/csv')
+            render_export(df_ex, df_trips, target_trip == "ALL")
 
-            display_cols = ['expense_date', 'category', 'item_name', 'amount', 'satisfaction', 'is_waste', 'detail', 'entry_id']
-            valid_cols = [c for c in display_cols if c in df_ex.columns]
-            sorted_df = df_ex[valid_cols].sort_values(by='expense_date', ascending=False)
-            st.dataframe(sorted_df.style.apply(highlight_audit_rows, axis=1), use_container_width=True, hide_index=True)
+            render_ledger(df_ex)
         else:
             st.info("支出データなし")
\ No newline at end of file
@@ -0,0 +1,49 @@
+import pytest
+
+from api_client import QuotaClient
+from archive import archive_trip, restore_trip
+from storage import MANIFEST_SHEET, FakeSpreadsheet, SheetsBackend, SqliteBackend
+
+
+def expense(entry_id, trip_id):
+    return [entry_id, trip_id, "2024-01-01 10:00:00", "食事", "昼食", 100, 3, "", "2024-01-01", "FALSE"]
+
+
+@pytest.fixture(params=["sheets", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "sheets":
+        backend = SheetsBackend(FakeSpreadsheet(), QuotaClient(per_minute=0, sleep=lambda s: None))
+    else:
+        backend = SqliteBackend(str(tmp_path / "audit.db"))
+    backend.append_rows("expenses", [expense("e1", "t1"), expense("e2", "t2"), expense("e3", "t1")])
+    return backend
+
+
+def ids(backend, sheet_name):
+    return sorted(r["entry_id"] for r in backend.read_records(sheet_name))
+
+
+def test_archive_is_idempotent(backend):
+    assert archive_trip(backend, "t1", "expenses_2024", "2024-12-31") == 2
+    assert archive_trip(backend, "t1", "expenses_2024", "2024-12-31") == 0
+    assert ids(backend, "expenses") == ["e2"]
+    assert ids(backend, "expenses_2024") == ["e1", "e3"]
+    manifest = backend.read_records(MANIFEST_SHEET)
+    assert [(r["trip_id"], r["row_count"]) for r in manifest] == [("t1", 2)]
+
+
+def test_archive_resumes_after_partial_copy(backend):
+    # パーティションへのコピーの途中で止まった状態から再実行する
+    backend.append_rows("expenses_2024", [expense("e1", "t1")])
+    archive_trip(backend, "t1", "expenses_2024", "2024-12-31")
+    assert ids(backend, "expenses_2024") == ["e1", "e3"]
+    assert ids(backend, "expenses") == ["e2"]
+
+
+def test_restore_is_idempotent(backend):
+    archive_trip(backend, "t1", "expenses_2024", "2024-12-31")
+    assert restore_trip(backend, "t1", "expenses_2024") == 2
+    assert restore_trip(backend, "t1", "expenses_2024") == 0
+    assert ids(backend, "expenses") == ["e1", "e2", "e3"]
+    assert ids(backend, "expenses_2024") == []
+    assert backend.read_records(MANIFEST_SHEET) == []
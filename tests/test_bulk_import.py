@@ -0,0 +1,52 @@
+from datetime import datetime
+
+import pandas as pd
+
+from bulk_import import Deduper, prepare_chunk
+from sheet_cache import normalize_frame
+from storage import HEADERS
+
+NOW = datetime(2024, 1, 10, 12, 0, 0)
+
+
+def csv_rows(*rows, category="食事"):
+    return pd.DataFrame(
+        [{"日付": d, "品目": item, "金額": str(amount), "カテゴリ": category} for d, item, amount in rows], dtype=str)
+
+
+def existing(*rows, category="食事"):
+    records = [
+        [f"x{i}", "t1", "2024-01-01 10:00:00", category, item, amount, 0, "", d, "FALSE"]
+        for i, (d, item, amount) in enumerate(rows)
+    ]
+    return normalize_frame("expenses", pd.DataFrame(records, columns=HEADERS["expenses"]))
+
+
+def new_rows(dedupe, raw, categories=("食事",)):
+    rows, _ = prepare_chunk(raw, "t1", {"t1"}, NOW, categories)
+    return rows[dedupe.new_mask(rows)]
+
+
+def test_deduper_counts_identical_rows():
+    # 既存に 1 件ある内容がファイルに 2 件あれば 1 件だけ取り込む
+    dedupe = Deduper(lambda trip_id: existing(("2024-01-03", "コンビニ", 1200)))
+    rows = new_rows(dedupe, csv_rows(("2024-01-03", "コンビニ", 1200), ("2024-01-03", "コンビニ", 1200)))
+    assert len(rows) == 1
+
+
+def test_deduper_counts_across_chunks():
+    dedupe = Deduper(lambda trip_id: existing(("2024-01-03", "コンビニ", 1200)))
+    first = new_rows(dedupe, csv_rows(("2024-01-03", "コンビニ", 1200)))
+    second = new_rows(dedupe, csv_rows(("2024-01-03", "コンビニ", 1200)))
+    assert (len(first), len(second)) == (0, 1)
+
+
+def test_deduper_keeps_existing_custom_category():
+    dedupe = Deduper(lambda trip_id: existing(("2024-01-03", "饅頭", 800), category="お土産"))
+    raw = csv_rows(("2024-01-03", "饅頭", 800), category="お土産")
+    assert len(new_rows(dedupe, raw, categories={"お土産"})) == 0
+
+
+def test_unknown_category_becomes_misc():
+    rows, _ = prepare_chunk(csv_rows(("2024-01-03", "謎", 10), category="未知"), "t1", {"t1"}, NOW)
+    assert rows["category"].tolist() == ["雑費"]
@@ -0,0 +1,101 @@
+from api_client import QuotaClient
+from storage import FakeSpreadsheet, RowIndex, SheetsBackend
+
+
+def expense(entry_id, trip_id, amount=100):
+    return [entry_id, trip_id, "2024-01-01 10:00:00", "食事", "昼食", amount, 3, "", "2024-01-01", "FALSE"]
+
+
+def make_backend(rows=()):
+    sheet = FakeSpreadsheet()
+    sheet.seed_rows("expenses", rows)
+    return sheet, SheetsBackend(sheet, QuotaClient(per_minute=0, sleep=lambda s: None))
+
+
+def sheet_ids(sheet):
+    return [r[0] for r in sheet.worksheet("expenses")._rows[1:]]
+
+
+# --- RowIndex ---
+
+def test_row_index_maps_ids_to_rows():
+    index = RowIndex(["a", "b", "c"], ["t1", "t1", "t2"])
+    assert index.row_of("a") == 2
+    assert index.row_of("c") == 4
+    assert index.row_of("x") is None
+
+
+def test_row_index_remove_shifts_rows_below():
+    index = RowIndex(["a", "b", "c", "d"], ["t1", "t2", "t2", "t1"])
+    index.remove_rows(3, 4)
+    assert index.ids == ["a", "d"]
+    assert index.row_of("d") == 3
+    assert index.tag_runs("t1") == [(2, 3)]
+    assert index.tag_runs("t2") == []
+
+
+def test_row_index_append_extends_runs():
+    index = RowIndex(["a", "b"], ["t1", "t2"])
+    assert index.tag_runs("t2") == [(3, 3)]
+    index.set_rows(4, ["c", "d"], ["t2", "t1"])
+    assert index.row_of("d") == 5
+    assert index.tag_runs("t2") == [(3, 4)]
+    assert index.tag_runs("t1") == [(2, 2), (5, 5)]
+
+
+def test_row_index_set_rows_pads_gap():
+    index = RowIndex(["a"], ["t1"])
+    index.set_rows(4, ["c"], ["t1"])
+    assert index.ids == ["a", "", "c"]
+    assert index.tag_runs("t1") == [(2, 2), (4, 4)]
+
+
+# --- SheetsBackend (FakeSpreadsheet) ---
+
+def test_read_trip_returns_only_trip_rows():
+    _, backend = make_backend([expense("e1", "t1"), expense("e2", "t2"), expense("e3", "t1")])
+    assert [r["entry_id"] for r in backend.read_trip("t1")] == ["e1", "e3"]
+    assert backend.read_trip("t9") == []
+
+
+def test_read_trip_after_other_session_deletes_rows():
+    sheet, backend = make_backend([expense("e1", "t1"), expense("e2", "t2"), expense("e3", "t1")])
+    backend.read_records("expenses")
+    other = SheetsBackend(sheet, QuotaClient(per_minute=0, sleep=lambda s: None))
+    other.delete_row("expenses", "e1")
+    assert [r["entry_id"] for r in backend.read_trip("t1")] == ["e3"]
+
+
+def test_read_trip_includes_rows_appended_by_other_session():
+    sheet, backend = make_backend([expense("e1", "t1")])
+    backend.read_records("expenses")
+    other = SheetsBackend(sheet, QuotaClient(per_minute=0, sleep=lambda s: None))
+    other.append_rows("expenses", [expense("e2", "t1")])
+    assert [r["entry_id"] for r in backend.read_trip("t1")] == ["e1", "e2"]
+
+
+def test_delete_where_removes_every_run():
+    sheet, backend = make_backend([expense("e1", "t1"), expense("e2", "t2"), expense("e3", "t1"), expense("e4", "t1")])
+    backend.read_records("expenses")
+    assert backend.delete_where("expenses", "trip_id", "t1") == 3
+    assert sheet_ids(sheet) == ["e2"]
+    assert backend.delete_where("expenses", "trip_id", "t1") == 0
+
+
+def test_delete_where_includes_rows_appended_by_other_session():
+    sheet, backend = make_backend([expense("e1", "t1"), expense("e2", "t2")])
+    backend.read_records("expenses")
+    other = SheetsBackend(sheet, QuotaClient(per_minute=0, sleep=lambda s: None))
+    other.append_rows("expenses", [expense("e3", "t1")])
+    assert backend.delete_where("expenses", "trip_id", "t1") == 2
+    assert sheet_ids(sheet) == ["e2"]
+
+
+def test_index_stays_aligned_after_delete_and_append():
+    sheet, backend = make_backend([expense("e1", "t1"), expense("e2", "t2"), expense("e3", "t1")])
+    backend.read_records("expenses")
+    backend.delete_row("expenses", "e1")
+    backend.append_rows("expenses", [expense("e4", "t2")])
+    backend.update_row("expenses", "e4", {"amount": 500})
+    assert sheet.worksheet("expenses")._rows[3][5] == 500
+    assert [r["entry_id"] for r in backend.read_trip("t2")] == ["e2", "e4"]
@@ -0,0 +1,114 @@
+import gspread
+import pytest
+
+import write_queue
+from storage import FakeResponse, SqliteBackend
+from write_queue import WriteQueue
+
+
+def expense(entry_id, trip_id="t1"):
+    return [entry_id, trip_id, "2024-01-01 10:00:00", "食事", "昼食", 100, 3, "", "2024-01-01", "FALSE"]
+
+
+def append(*entry_ids):
+    return {"op": "append", "sheet": "expenses", "rows": [expense(e) for e in entry_ids]}
+
+
+def ids(backend):
+    return [r["entry_id"] for r in backend.read_records("expenses")]
+
+
+@pytest.fixture(autouse=True)
+def no_wait(monkeypatch):
+    monkeypatch.setattr(write_queue, "BATCH_WINDOW", 0)
+    monkeypatch.setattr(write_queue, "RETRY_BASE", 0.001)
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return SqliteBackend(str(tmp_path / "audit.db"))
+
+
+# 書き込みは届いたが応答が 429 で失われた、を 1 回だけ起こす
+class LostResponseBackend(SqliteBackend):
+    def __init__(self, path):
+        super().__init__(path)
+        self.failures = 1
+
+    def append_rows(self, sheet_name, rows):
+        super().append_rows(sheet_name, rows)
+        if self.failures:
+            self.failures -= 1
+            raise gspread.exceptions.APIError(FakeResponse(429, "Quota exceeded"))
+
+
+def test_transient_error_is_retried_without_duplicates(tmp_path):
+    backend = LostResponseBackend(str(tmp_path / "audit.db"))
+    queue = WriteQueue(backend, str(tmp_path / "queue.jsonl")).start()
+    queue.submit(append("e1", "e2"))
+    assert queue.flush(5)
+    assert ids(backend) == ["e1", "e2"]
+    assert queue.failed == []
+
+
+def test_permanent_error_is_set_aside(backend, tmp_path):
+    applied = []
+    queue = WriteQueue(backend, str(tmp_path / "queue.jsonl"), on_applied=lambda op, result, error: applied.append((op["op"], error)))
+    queue.start()
+    queue.submit({"op": "update", "sheet": "expenses", "key": "missing", "values": {"amount": 1}})
+    queue.submit(append("e1"))
+    assert queue.flush(5)
+    assert [op["op"] for op in queue.failed] == ["update"]
+    assert ids(backend) == ["e1"]
+    assert applied[0][0] == "update" and applied[0][1] is not None
+    assert applied[1] == ("append", None)
+
+
+def test_worker_survives_failing_callback(backend, tmp_path):
+    def on_applied(op, result, error):
+        raise RuntimeError("boom")
+
+    queue = WriteQueue(backend, str(tmp_path / "queue.jsonl"), on_applied=on_applied).start()
+    queue.submit(append("e1"))
+    assert queue.flush(5)
+    queue.submit(append("e2"))
+    assert queue.flush(5)
+    assert ids(backend) == ["e1", "e2"]
+
+
+def test_replay_skips_rows_already_written(backend, tmp_path):
+    path = str(tmp_path / "queue.jsonl")
+    WriteQueue(backend, path).submit_many([append("e1"), append("e2")])
+    # 送信済みだが完了記録を書く前にプロセスが落ちた状態
+    backend.append_rows("expenses", [expense("e1")])
+    queue = WriteQueue(backend, path)
+    assert queue.size() == 2
+    queue.start()
+    assert queue.flush(5)
+    assert ids(backend) == ["e1", "e2"]
+    assert queue.failed == []
+
+
+def test_journal_drops_completed_ops(backend, tmp_path):
+    path = str(tmp_path / "queue.jsonl")
+    queue = WriteQueue(backend, path)
+    queue.submit_many([append("e1"), append("e2"), append("e3")])
+    queue._complete([queue.ops[0]], 1, None)
+    assert [op["rows"][0][0] for op in WriteQueue(backend, path).ops] == ["e2", "e3"]
+
+
+def test_journal_ignores_torn_last_line(backend, tmp_path):
+    path = str(tmp_path / "queue.jsonl")
+    WriteQueue(backend, path).submit(append("e1"))
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"submit": {"op": "app')
+    assert WriteQueue(backend, path).size() == 1
+
+
+def test_journal_is_compacted_when_drained(backend, tmp_path):
+    path = str(tmp_path / "queue.jsonl")
+    queue = WriteQueue(backend, path).start()
+    queue.submit_many([append("e1"), append("e2")])
+    assert queue.flush(5)
+    with open(path, encoding="utf-8") as f:
+        assert f.read() == ""
@@ -3,12 +3,24 @@ import pandas as pd
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from datetime import datetime
-import uuid
 import time
+import uuid
+import storage
+from sheet_cache import SheetCache, TripCacheStore
+from rollups import RollupStore
+from api_client import QuotaClient, SHEETS_QUOTA_PER_MINUTE
+from write_queue import WriteQueue
+from archive import ARCHIVE_STATUSES, partition_for
+from snapshot import SnapshotStore
+from metrics import METRICS, count_http_bytes
+from figure_cache import FigureCache
+import bulk_import
+import analytics
 
 # --- 設定 & 定数 ---
 SCOPE = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
 SPREADSHEET_NAME = "TravelAuditDB"
+IMPORT_SYNC_TIMEOUT = 120  # 一括取り込みで書き込み完了を待つ最大秒数
 
 # カラーパレット
 COLOR_RED = "#FF4B4B"
@@ -30,18 +42,17 @@ CATEGORY_COLOR_MAP = {
 
 # --- ヘルパー関数 ---
 
-def execute_with_retry(func, *args, max_retries=3, **kwargs):
-    for i in range(max_retries):
-        try:
+def execute_with_retry(func, *args, **kwargs):
+    # 再試行・バックオフは QuotaClient (SheetsBackend 内) が行う。ここでは最終的な失敗を表示する
+    try:
+        with METRICS.timer(f"storage.{getattr(func, '__name__', 'call')}"):
             return func(*args, **kwargs)
-        except gspread.exceptions.APIError as e:
-            if i == max_retries - 1:
-                st.error(f"Google APIエラー (Wait & Retry Failed): {e}")
-                st.stop()
-            time.sleep(1 + i)
-        except Exception as e:
-            st.error(f"予期せぬエラー: {e}")
-            st.stop()
+    except storage.TRANSIENT_ERRORS as e:
+        st.error(f"Google APIエラー (Wait & Retry Failed): {e}")
+        st.stop()
+    except Exception as e:
+        st.error(f"予期せぬエラー: {e}")
+        st.stop()
 
 @st.cache_resource(ttl=600)
 def connect_db():
@@ -52,141 +63,465 @@ def connect_db():
         else:
             creds = ServiceAccountCredentials.from_json_keyfile_name("service_account.json", SCOPE)
         client = gspread.authorize(creds)
+        count_http_bytes(client.http_client.session)
         sheet = client.open(SPREADSHEET_NAME)
         return sheet
     except Exception as e:
         st.error(f"データベース接続失敗: {e}")
         st.stop()
 
-def get_worksheet_object(sheet_name):
-    sheet = connect_db()
-    try:
-        return sheet.worksheet(sheet_name)
-    except gspread.exceptions.WorksheetNotFound:
-        st.error(f"ワークシート '{sheet_name}' が見つかりません。")
-        st.stop()
+def storage_conf():
+    return st.secrets["storage"] if "storage" in st.secrets else {}
 
-# --- データ操作 (CRUD) ---
+@st.cache_resource
+def get_backend():
+    # st.secrets の [storage] backend = "sheets" (既定) | "sqlite" | "memory"
+    conf = storage_conf()
+    kind = conf.get("backend", "sheets")
+    if kind == "sqlite":
+        return storage.SqliteBackend(conf.get("path", "travel_audit.db"))
+    if kind == "memory":
+        client = QuotaClient(per_minute=int(conf.get("quota_per_minute", 0)))
+        spreadsheet = storage.FakeSpreadsheet(latency=float(conf.get("latency", 0)), error_rate=float(conf.get("error_rate", 0)))
+        return storage.SheetsBackend(spreadsheet, client)
+    client = QuotaClient(per_minute=int(conf.get("quota_per_minute", SHEETS_QUOTA_PER_MINUTE)))
+    return storage.SheetsBackend(connect_db(), client)
+
+# --- キャッシュ ---
+
+@st.cache_resource
+def get_rollups():
+    return RollupStore()
+
+@st.cache_resource
+def get_figure_cache():
+    return FigureCache()
+
+@st.cache_resource
+def get_analytics_cache():
+    return {}
+
+@st.cache_resource
+def get_ledger_cache():
+    return {}
+
+@st.cache_resource
+def get_snapshot_store():
+    # 再起動・別レプリカでも初回表示を速くするためのディスクスナップショット。
+    # memory バックエンドはプロセス毎に中身が異なるため既定では使わない
+    conf = storage_conf()
+    default = "" if conf.get("backend", "sheets") == "memory" else ".snapshot"
+    directory = conf.get("snapshot_dir", default)
+    if not directory or not SnapshotStore.available():
+        return None
+    return SnapshotStore(directory)
+
+def _new_sheet_cache(sheet_name):
+    cache = SheetCache(sheet_name, storage.header_for(sheet_name))
+    snapshot = get_snapshot_store()
+    if snapshot is not None:
+        cache.snapshot = snapshot
+        cache.marker = get_backend().version_marker
+    return cache
+
+@st.cache_resource
+def get_sheet_caches():
+    # プロセス全体で共有するシート毎のキャッシュ。アーカイブパーティションの分は sheet_cache() が初回利用時に追加する
+    return {name: _new_sheet_cache(name) for name in storage.HEADERS}
+
+def sheet_cache(sheet_name):
+    caches = get_sheet_caches()
+    cache = caches.get(sheet_name)
+    if cache is None:
+        if not storage.is_partition(sheet_name):
+            raise storage.StorageError(f"未知のシート名: {sheet_name}")
+        cache = _new_sheet_cache(sheet_name)
+        queue = get_write_queue()
+        cache.pending_rows = lambda: queue.pending_rows(sheet_name)
+        cache = caches.setdefault(sheet_name, cache)
+    return cache
+
+@st.cache_resource
+def get_trip_caches():
+    # 旅行単位の支出キャッシュ。旅行別集計はこのキャッシュの差分で更新される
+    store = TripCacheStore("expenses", storage.HEADERS["expenses"])
+    store.listeners.append(get_rollups())
+    return store
 
-@st.cache_data(ttl=300)
 def load_cached_data(sheet_name):
-    ws = get_worksheet_object(sheet_name)
-    try:
-        data = ws.get_all_records()
-        return pd.DataFrame(data)
-    except gspread.exceptions.APIError:
-        time.sleep(2)
-        data = ws.get_all_records()
-        return pd.DataFrame(data)
+    backend = get_backend()
+    df = sheet_cache(sheet_name).get(
+        lambda: execute_with_retry(backend.read_records, sheet_name),
+        lambda offset: execute_with_retry(backend.read_tail, sheet_name, offset),
+    )
+    # キャッシュ本体は共有されるため浅いコピーを返す (呼び出し側での列追加は本体に影響しない)
+    return df.copy(deep=False)
+
+def expense_sheet(trip_id):
+    # アーカイブ済みの旅行は manifest に記録されたパーティション、それ以外は expenses
+    manifest = load_cached_data(storage.MANIFEST_SHEET)
+    hit = manifest.loc[manifest['trip_id'] == str(trip_id), 'partition']
+    return hit.iloc[0] if not hit.empty else "expenses"
+
+def locate_expense(entry_id):
+    # entry_id の (trip_id, シート名) を返す。見つからなければ None。
+    # ホットシートと各パーティションのキャッシュ (load_ledger) から引くため、存在しない ID でも再読み込みしない
+    ledger, _ = load_ledger()
+    hit = ledger.loc[ledger['entry_id'] == str(entry_id), 'trip_id']
+    if hit.empty:
+        return None
+    return hit.iloc[0], expense_sheet(hit.iloc[0])
+
+def archived_trip_ids():
+    return set(load_cached_data(storage.MANIFEST_SHEET)['trip_id'])
+
+def load_trip_expenses(trip_id):
+    # 1 旅行分の支出だけを取得する。全件 (ALL) 表示以外はこちらを使う
+    backend = get_backend()
+    df = get_trip_caches().get(trip_id, lambda t: execute_with_retry(backend.read_trip, t, expense_sheet(t)))
+    return df.copy(deep=False)
+
+def iter_trip_expenses(df_trips):
+    # 旅行毎の支出を 1 件ずつ返す (エクスポート用)。ホットな旅行は全件キャッシュから切り出し、
+    # アーカイブ済みの旅行はパーティションから読む
+    hot = load_cached_data("expenses")
+    positions = hot.groupby('trip_id', sort=False).indices
+    archived = archived_trip_ids()
+    for trip_id, trip_name in zip(df_trips['trip_id'], df_trips['trip_name']):
+        if trip_id in archived:
+            yield trip_id, trip_name, load_trip_expenses(trip_id)
+        else:
+            yield trip_id, trip_name, hot.iloc[positions.get(trip_id, [])]
+
+def data_version(sheet_name):
+    return sheet_cache(sheet_name).version
+
+def trip_data_version(trip_id):
+    return get_trip_caches().version(trip_id)
+
+def get_trip_rollup(trip_id):
+    load_trip_expenses(trip_id)
+    return get_rollups().get(trip_id)
+
+def trip_figure(kind, trip_id, build):
+    # 旅行の支出と旅行一覧 (予算) のどちらかが変わった時だけ build() で作り直す
+    key = (kind, str(trip_id), trip_data_version(trip_id), data_version("trips"))
+    return get_figure_cache().get(key, build)
+
+def load_ledger():
+    # ALL 表示・エクスポート用の全支出。ホットシートに manifest の各パーティションを合わせ、
+    # アーカイブ済みの旅行も含める。結合結果は各シートと manifest の version が変わるまで使い回す。
+    # (結合後の台帳, version) を返す
+    partitions = sorted(load_cached_data(storage.MANIFEST_SHEET)['partition'].unique())
+    sheets = ["expenses", *partitions]
+    frames = [load_cached_data(name) for name in sheets]
+    version = (tuple(data_version(name) for name in sheets), data_version(storage.MANIFEST_SHEET))
+    cache = get_ledger_cache()
+    ledger = cache.get(version)
+    if ledger is None:
+        ledger = analytics.combine_ledgers(frames)
+        cache.clear()
+        cache[version] = ledger
+    return ledger.copy(deep=False), version
+
+def get_analytics():
+    # ALL 表示用の旅行横断分析 (アーカイブ済みの旅行を含む)。
+    # 支出 (ホット・各パーティション)・旅行一覧・manifest の version と日付が変わった時だけ計算し直す
+    df_trips = load_cached_data("trips")
+    ledger, ledger_version = load_ledger()
+    key = (ledger_version, data_version("trips"), datetime.today().date())
+    cache = get_analytics_cache()
+    result = cache.get(key)
+    if result is None:
+        with METRICS.timer("analytics.compute"):
+            result = analytics.compute(ledger, df_trips, key[-1])
+        # 派生するグラフのキャッシュキーに使う
+        result["version"] = key
+        cache.clear()
+        cache[key] = result
+    return result
+
+def ledger_figure(kind, params, version, build):
+    # 横断分析から作るグラフ用。version は get_analytics() の結果の version (ホット・各パーティション・
+    # 旅行一覧・manifest の version)、params は表示対象の旅行など、同じデータでも図が変わる引数
+    key = (kind, params, version)
+    return get_figure_cache().get(key, build)
+
+def verify_rollups():
+    frames = [c.df for c in get_trip_caches().cached() if c.df is not None]
+    if not frames:
+        return []
+    return get_rollups().verify(pd.concat(frames, ignore_index=True))
 
 def clear_all_caches():
-    load_cached_data.clear()
+    for cache in list(get_sheet_caches().values()):
+        cache.invalidate()
+    get_trip_caches().invalidate()
+    get_figure_cache().clear()
+
+# --- 書き込みキュー ---
+
+def _apply_local(caches, trip_caches, op):
+    # 書き込み操作をメモリ上のキャッシュへ反映し、削除件数を返す (再適用しても結果は変わらない)。
+    # アーカイブパーティションはシート全体のキャッシュを持たず、旅行単位のキャッシュだけを更新する
+    sheet_name = op["sheet"]
+    targets = [caches[sheet_name]] if sheet_name in caches else []
+    if storage.base_sheet(sheet_name) == "expenses":
+        targets.append(trip_caches)
+    removed = 0
+    for cache in targets:
+        if op["op"] == "append":
+            cache.apply_append(op["rows"])
+        elif op["op"] == "update":
+            cache.apply_update(op["key"], op["values"])
+        elif op["op"] == "delete_row":
+            column = storage.header_for(sheet_name)[op.get("col", 1) - 1]
+            removed = max(removed, cache.apply_delete(column, op["value"], first_only=True))
+        elif op["op"] == "delete_where":
+            removed = max(removed, cache.apply_delete(op["column"], op["value"]))
+    return removed
+
+def _reconcile(caches, trip_caches, queue, op, result, error):
+    # ワーカーで送信が終わった操作をキャッシュへ反映する (楽観的反映済みの内容と冪等)
+    sheet_name = op["sheet"]
+    cache = caches.get(sheet_name)
+    if error is not None:
+        # 反映できなかった楽観的更新は捨てて、次回表示時に取り直す
+        if cache is not None:
+            cache.invalidate()
+        if storage.base_sheet(sheet_name) == "expenses":
+            trip_caches.invalidate()
+        return
+    if op["op"] in ("archive", "restore"):
+        # 移動は楽観的に反映しない。完了後に manifest を取り直し、ホット側の表示を合わせる
+        caches[storage.MANIFEST_SHEET].invalidate()
+        partition = caches.get(op["partition"])
+        if partition is not None:
+            partition.invalidate()
+        if op["op"] == "archive":
+            cache.adjust_row_count(-int(result or 0))
+            cache.apply_delete("trip_id", op["trip_id"])
+        else:
+            cache.invalidate()
+        return
+    if cache is None:
+        _apply_local(caches, trip_caches, op)
+        return
+    if op["op"] == "append":
+        cache.adjust_row_count(len(op["rows"]))
+    elif op["op"] == "update":
+        # 同じ行への新しい更新が待機中なら、古い値で上書きしない
+        if str(op["key"]) in queue.pending_keys(sheet_name):
+            return
+    elif op["op"] == "delete_row":
+        cache.adjust_row_count(-1)
+        if op.get("col", 1) != 1:
+            return
+    elif op["op"] == "delete_where":
+        cache.adjust_row_count(-int(result or 0))
+    _apply_local(caches, trip_caches, op)
+
+@st.cache_resource
+def get_write_queue():
+    conf = storage_conf()
+    caches = get_sheet_caches()
+    trip_caches = get_trip_caches()
+    queue = WriteQueue(get_backend(), conf.get("queue_path", ".write_queue.jsonl"))
+    queue.on_applied = lambda op, result, error: _reconcile(caches, trip_caches, queue, op, result, error)
+    for name, cache in list(caches.items()):
+        cache.pending_rows = lambda name=name: queue.pending_rows(name)
+    trip_caches.pending_rows = lambda: queue.pending_rows("expenses", partitions=True)
+    return queue.start()
+
+def submit_write(op):
+    # キューへ登録し、結果を待たずにキャッシュへ楽観的に反映する
+    get_write_queue().submit(op)
+    return _apply_local(get_sheet_caches(), get_trip_caches(), op)
+
+def pending_keys(sheet_name):
+    return get_write_queue().pending_keys(sheet_name)
+
+def flash(message, kind="toast"):
+    # st.rerun() 後の描画で表示するメッセージ (待ち時間の sleep の代わり)
+    st.session_state.setdefault("_flash", []).append((kind, message))
+
+def show_flash():
+    for kind, message in st.session_state.pop("_flash", []):
+        if kind == "toast": st.toast(message)
+        elif kind == "success": st.success(message)
+        else: st.info(message)
+
+def render_sync_status():
+    queue = get_write_queue()
+    size = queue.size()
+    if size:
+        st.sidebar.caption(f"⏳ 同期待ち {size} 件")
+    if queue.failed:
+        with st.sidebar.expander(f"⚠️ 同期失敗 {len(queue.failed)} 件"):
+            for op in queue.failed[-10:]:
+                st.caption(f"{op['op']} / {op['sheet']}: {op['error']}")
+
+def diagnostics():
+    # 管理画面の診断タブ用。JSON にそのまま書ける dict を返す
+    backend = get_backend()
+    queue = get_write_queue()
+    client = getattr(backend, "client", None)
+    caches = {
+        name: {"rows": 0 if c.df is None else len(c.df), "version": c.version, "row_count": c.row_count}
+        for name, c in list(get_sheet_caches().items())
+    }
+    return {
+        **METRICS.snapshot(),
+        "backend": type(backend).__name__,
+        "quota": client.stats() if client is not None else {},
+        "queue": {"pending": queue.size(), "failed": len(queue.failed)},
+        "caches": caches,
+        "trip_caches": len(get_trip_caches().cached()),
+    }
+
+# --- データ操作 (CRUD) ---
 
 def add_trip(name, start, end, budget, detail):
-    ws = get_worksheet_object("trips")
     t_id = str(uuid.uuid4())[:8]
     new_row = [t_id, name, str(start), str(end), "Planning", budget, detail]
-    execute_with_retry(ws.append_row, new_row)
-    clear_all_caches()
-    st.toast(f"プロジェクト '{name}' を作成しました。")
-    time.sleep(1)
+    execute_with_retry(submit_write, {"op": "append", "sheet": "trips", "rows": [new_row]})
+    flash(f"プロジェクト '{name}' を作成しました。")
     st.rerun()
 
 def update_trip_info(trip_id, name, start, end, budget, status, detail):
-    ws = get_worksheet_object("trips")
     try:
-        cell = ws.find(trip_id, in_column=1)
-        row_num = cell.row
-        ws.update_cell(row_num, 2, name)
-        ws.update_cell(row_num, 3, str(start))
-        ws.update_cell(row_num, 4, str(end))
-        ws.update_cell(row_num, 5, status)
-        ws.update_cell(row_num, 6, budget)
-        ws.update_cell(row_num, 7, detail)
-        clear_all_caches()
-        st.success(f"旅行 '{name}' の情報を更新しました。")
-        time.sleep(1)
+        values = {
+            "trip_name": name, "start_date": str(start), "end_date": str(end),
+            "status": status, "total_budget": budget, "detail": detail,
+        }
+        submit_write({"op": "update", "sheet": "trips", "key": trip_id, "values": values})
+        flash(f"旅行 '{name}' の情報を更新しました。", "success")
+        # 完了・中止はアーカイブへ、進行中に戻した場合はホットシートへ戻す
+        sheet = expense_sheet(trip_id)
+        if status in ARCHIVE_STATUSES and sheet == "expenses":
+            submit_archive(trip_id, partition_for(values))
+            flash("支出をアーカイブへ移動しています (バックグラウンドで処理します)。")
+        elif status not in ARCHIVE_STATUSES and sheet != "expenses":
+            submit_write({"op": "restore", "sheet": "expenses", "trip_id": trip_id, "partition": sheet})
+            flash("支出をアーカイブから戻しています (バックグラウンドで処理します)。")
         st.rerun()
     except Exception as e:
         st.error(f"更新エラー: {e}")
 
+def submit_archive(trip_id, partition):
+    archived_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    submit_write({"op": "archive", "sheet": "expenses", "trip_id": trip_id, "partition": partition, "archived_at": archived_at})
+
+def archive_finished_trips():
+    # 完了・中止済みでまだホットシートにある旅行をまとめてアーカイブする
+    df_trips = load_cached_data("trips")
+    targets = df_trips[df_trips['status'].isin(ARCHIVE_STATUSES) & ~df_trips['trip_id'].isin(archived_trip_ids())]
+    for trip in targets.to_dict("records"):
+        submit_archive(trip['trip_id'], partition_for(trip))
+    flash(f"{len(targets)} 件の旅行をアーカイブ対象に登録しました。", "success")
+    st.rerun()
+
 def add_expense(trip_id, category, item, amount, sat, detail, exp_date, is_waste):
-    ws = get_worksheet_object("expenses")
     e_id = str(uuid.uuid4())
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     date_str = str(exp_date) if exp_date else datetime.now().strftime("%Y-%m-%d")
     waste_str = "TRUE" if is_waste else "FALSE"
     
     new_row = [e_id, trip_id, ts, category, item, amount, sat, detail, date_str, waste_str]
-    execute_with_retry(ws.append_row, new_row)
-    clear_all_caches()
-    st.toast("支出を監査ログに記録しました。")
-    time.sleep(1)
+    execute_with_retry(submit_write, {"op": "append", "sheet": "expenses", "rows": [new_row]})
+    flash("支出を監査ログに記録しました。")
     st.rerun()
 
-def update_expense(entry_id, category, item, amount, sat, detail, exp_date, is_waste):
-    ws = get_worksheet_object("expenses")
+def update_expense(entry_id, category, item, amount, sat, detail, exp_date, is_waste, sheet_name="expenses"):
     try:
-        cell = ws.find(entry_id, in_column=1)
-        row_num = cell.row
         date_str = str(exp_date)
         waste_str = "TRUE" if is_waste else "FALSE"
         
-        ws.update_cell(row_num, 4, category)
-        ws.update_cell(row_num, 5, item)
-        ws.update_cell(row_num, 6, amount)
-        ws.update_cell(row_num, 7, sat)
-        ws.update_cell(row_num, 8, detail)
-        ws.update_cell(row_num, 9, date_str)
-        ws.update_cell(row_num, 10, waste_str)
-        
-        clear_all_caches()
-        st.success("データの修正が完了しました。")
-        time.sleep(1)
+        values = {
+            "category": category, "item_name": item, "amount": amount, "satisfaction": sat,
+            "detail": detail, "expense_date": date_str, "is_waste": waste_str,
+        }
+        submit_write({"op": "update", "sheet": sheet_name, "key": entry_id, "values": values})
+        flash("データの修正が完了しました。", "success")
         st.rerun()
     except Exception as e:
         st.error(f"更新エラー: {e}")
 
 def delete_row_simple(worksheet_name, id_col_val, id_col_index=1):
-    ws = get_worksheet_object(worksheet_name)
     try:
-        cell = ws.find(id_col_val, in_column=id_col_index)
-        if hasattr(ws, 'delete_rows'): ws.delete_rows(cell.row)
-        else: ws.delete_row(cell.row)
-        clear_all_caches()
-        st.success("削除完了")
-        time.sleep(1)
+        # 書き込みはキュー経由で後から失敗するため、存在しない ID はここで弾く
+        if worksheet_name == "expenses" and id_col_index == 1:
+            # アーカイブ済みの旅行の支出はパーティション側から消す
+            located = locate_expense(id_col_val)
+            if located is None:
+                raise storage.StorageError(f"ID '{id_col_val}' が見つかりません。")
+            worksheet_name = located[1]
+        elif worksheet_name in get_sheet_caches():
+            column = storage.header_for(worksheet_name)[id_col_index - 1]
+            if not (load_cached_data(worksheet_name)[column].astype(str) == str(id_col_val)).any():
+                raise storage.StorageError(f"ID '{id_col_val}' が見つかりません。")
+        submit_write({"op": "delete_row", "sheet": worksheet_name, "value": id_col_val, "col": id_col_index})
+        flash("削除しました (バックグラウンドで同期します)。", "success")
         st.rerun()
     except Exception as e:
         st.error(f"削除エラー: {e}")
 
 def delete_trip_cascade(trip_id, trip_name):
-    ws_exp = get_worksheet_object("expenses")
-    ws_trip = get_worksheet_object("trips")
-    status_box = st.empty()
-    status_box.info("⚠️ 関連データの削除処理を開始します...")
-    time.sleep(2)
     try:
-        all_expenses = ws_exp.get_all_records()
-        if all_expenses:
-            df = pd.DataFrame(all_expenses)
-            if 'trip_id' in df.columns:
-                remaining_df = df[df['trip_id'] != trip_id]
-                ws_exp.clear()
-                header = ["entry_id", "trip_id", "timestamp", "category", "item_name", "amount", "satisfaction", "detail", "expense_date", "is_waste"]
-                ws_exp.append_row(header)
-                if not remaining_df.empty:
-                    for col in header:
-                        if col not in remaining_df.columns: remaining_df[col] = ""
-                    data_to_write = remaining_df[header].values.tolist()
-                    ws_exp.append_rows(data_to_write)
-        
-        cell = ws_trip.find(trip_id, in_column=1)
-        if hasattr(ws_trip, 'delete_rows'): ws_trip.delete_rows(cell.row)
-        else: ws_trip.delete_row(cell.row)
-        clear_all_caches()
-        status_box.success(f"旅行「{trip_name}」と全関連データの完全消去が完了しました。")
-        time.sleep(2)
+        sheet = expense_sheet(trip_id)
+        # 件数はキャッシュへの楽観的反映ではなく、削除前に旅行の支出を読んで数える (未表示の旅行でも正しい件数になる)
+        removed = len(load_trip_expenses(trip_id))
+        submit_write({"op": "delete_where", "sheet": sheet, "column": "trip_id", "value": trip_id})
+        if sheet != "expenses":
+            submit_write({"op": "delete_row", "sheet": storage.MANIFEST_SHEET, "value": trip_id, "col": 1})
+        submit_write({"op": "delete_row", "sheet": "trips", "value": trip_id, "col": 1})
+        flash(f"旅行「{trip_name}」と関連支出 {removed} 件の削除を受け付けました (バックグラウンドで同期します)。", "success")
         st.rerun()
     except Exception as e:
         st.error(f"完全削除中にエラーが発生しました: {e}")
+
+# --- 一括取り込み ---
+
+def import_expenses(f, trip_id=None, on_progress=None):
+    # CSV をチャンク毎に検証・重複除去し、WRITE_CHUNK_ROWS 行ずつ書き込みキューへ登録する。
+    # trip_id が None なら CSV の trip_id 列に従う
+    known = set(load_cached_data("trips")['trip_id'])
+    ledger, _ = load_ledger()
+    categories = set(ledger['category'].dropna().astype(str))
+    dedupe = bulk_import.Deduper(load_trip_expenses)
+    queue = get_write_queue()
+    caches, trip_caches = get_sheet_caches(), get_trip_caches()
+    now = datetime.now()
+    result = {"read": 0, "queued": 0, "duplicates": 0, "rejected": [], "op_ids": []}
+    for chunk in bulk_import.read_chunks(f):
+        rows, rejected = bulk_import.prepare_chunk(chunk, trip_id, known, now, categories)
+        keep = dedupe.new_mask(rows)
+        rows = rows[keep]
+        ops = [
+            {"op": "append", "sheet": expense_sheet(t), "rows": bulk_import.to_rows(group.iloc[i:i + bulk_import.WRITE_CHUNK_ROWS])}
+            for t, group in rows.groupby("trip_id", sort=False)
+            for i in range(0, len(group), bulk_import.WRITE_CHUNK_ROWS)
+        ]
+        if ops:
+            result["op_ids"] += queue.submit_many(ops)
+            for op in ops:
+                _apply_local(caches, trip_caches, op)
+        result["read"] += len(chunk)
+        result["queued"] += len(rows)
+        result["duplicates"] += int((~keep).sum())
+        result["rejected"].append(rejected)
+        if on_progress:
+            on_progress(result)
+    result["rejected"] = pd.concat(result["rejected"]) if result["rejected"] else pd.DataFrame()
+    return result
+
+def wait_for_sync(op_ids, on_progress, timeout=IMPORT_SYNC_TIMEOUT):
+    # 登録した操作の書き込み完了を待つ。打ち切っても未送信分はキューに残り、バックグラウンドで送られる
+    queue = get_write_queue()
+    deadline = time.monotonic() + timeout
+    while True:
+        pending, failed = queue.outstanding(op_ids)
+        on_progress(len(op_ids) - pending, len(op_ids))
+        if not pending or time.monotonic() > deadline:
+            return pending, failed
+        time.sleep(0.5)
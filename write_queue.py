@@ -0,0 +1,244 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+from archive import archive_trip, restore_trip
+from metrics import METRICS
+from storage import StorageError, base_sheet, is_transient
+
+# --- 設定 ---
+BATCH_WINDOW = 0.3    # 連続入力をまとめるため、最初の書き込み受付後に待つ秒数
+RETRY_BASE = 2.0
+RETRY_MAX = 60.0
+MAX_BATCH_ROWS = 2000  # まとめて送る append の上限行数 (一括取り込み時に 1 リクエストが巨大にならないように)
+COMPACT_AFTER = 500    # ジャーナルの完了記録がこの件数を超えたら未送信分だけに書き直す
+
+log = logging.getLogger(__name__)
+
+
+# バックグラウンドでストレージへ書き込むキュー。
+# 操作は受付時にローカルファイル (追記型のジャーナル) へ永続化し、プロセスが再起動しても未送信分を再送する (at-least-once)。
+# ジャーナルは {"submit": 操作} と {"done": [id, ...]} の行からなり、受付・完了毎に新しい行だけを追記する。
+# 完了記録が溜まったら (またはキューが空になったら) 未送信の操作だけに書き直す。
+# 連続する同一シートへの append はまとめて 1 回の append_rows で送る。
+# 再起動後の再送や一時的エラー後の再送では、前回の送信が届いていた可能性があるため、
+# append は既にシートにある ID の行を除いてから送る (通常の送信では確認のための読み取りはしない)。
+# on_applied(op, result, error) は各操作の送信完了 (または失敗) 後にワーカースレッドから呼ばれる。
+#
+# 操作の形式 (dict):
+#   {"op": "append", "sheet": ..., "rows": [[...], ...]}
+#   {"op": "update", "sheet": ..., "key": ..., "values": {...}}
+#   {"op": "delete_row", "sheet": ..., "value": ..., "col": 1}
+#   {"op": "delete_where", "sheet": ..., "column": ..., "value": ...}
+#   {"op": "archive", "sheet": "expenses", "trip_id": ..., "partition": ..., "archived_at": ...}
+#   {"op": "restore", "sheet": "expenses", "trip_id": ..., "partition": ...}
+class WriteQueue:
+    def __init__(self, backend, path, on_applied=None):
+        self.backend = backend
+        self.path = path
+        self.on_applied = on_applied
+        self.ops = []
+        self.failed = []
+        self.done_logged = 0   # 前回の書き直し以降にジャーナルへ追記した完了記録の件数
+        self.cond = threading.Condition()
+        self.thread = None
+        self._load()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="write-queue", daemon=True)
+        self.thread.start()
+        return self
+
+    # --- 永続化 ---
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        ops, done = {}, set()
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 書き込み途中で落ちた末尾の行は受付が完了していないので捨てる
+                    log.warning("書き込みキューの壊れた行を読み飛ばしました")
+                    continue
+                if "done" in record:
+                    done.update(record["done"])
+                else:
+                    # 旧形式 (操作をそのまま 1 行ずつ保存) も読めるようにする
+                    op = record.get("submit", record)
+                    ops[op["id"]] = op
+        self.ops = [dict(op, replay=True) for op_id, op in ops.items() if op_id not in done]
+        self._compact()
+
+    def _append(self, records):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _compact(self):
+        # 未送信の操作だけを書き直す。キューが空なら空ファイルになる
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for op in self.ops:
+                f.write(json.dumps({"submit": op}, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.done_logged = 0
+
+    # --- 受付 ---
+
+    def submit(self, op):
+        return self.submit_many([op])[0]
+
+    def submit_many(self, ops):
+        # 追記と fsync は 1 回にまとめる (一括取り込みで大量の操作を登録する場合)
+        ops = [dict(op, id=str(uuid.uuid4()), submitted_at=time.time()) for op in ops]
+        with self.cond:
+            self._append({"submit": op} for op in ops)
+            self.ops.extend(ops)
+            self.cond.notify()
+        return [op["id"] for op in ops]
+
+    def pending_keys(self, sheet_name):
+        # 未同期の行 ID (append / update 対象) を返す
+        with self.cond:
+            keys = set()
+            for op in self.ops:
+                if op["sheet"] != sheet_name:
+                    continue
+                if op["op"] == "append":
+                    keys.update(str(r[0]) for r in op["rows"])
+                elif op["op"] == "update":
+                    keys.add(str(op["key"]))
+            return keys
+
+    def pending_rows(self, sheet_name, partitions=False):
+        # partitions=True なら同じスキーマのアーカイブパーティションへの追記も含める
+        match = (lambda s: base_sheet(s) == sheet_name) if partitions else (lambda s: s == sheet_name)
+        with self.cond:
+            return [r for op in self.ops if op["op"] == "append" and match(op["sheet"]) for r in op["rows"]]
+
+    def outstanding(self, op_ids):
+        # op_ids のうち (未送信の件数, 失敗した件数)
+        ids = set(op_ids)
+        with self.cond:
+            return sum(op["id"] in ids for op in self.ops), sum(op["id"] in ids for op in self.failed)
+
+    def size(self):
+        with self.cond:
+            return len(self.ops)
+
+    def flush(self, timeout=None):
+        # キューが空になるまで待つ (ベンチマーク・終了処理用)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.ops:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    # --- ワーカー ---
+
+    def _next_batch(self):
+        first = self.ops[0]
+        if first["op"] != "append":
+            return [first]
+        batch = [first]
+        rows = len(first["rows"])
+        for op in self.ops[1:]:
+            if op["op"] != "append" or op["sheet"] != first["sheet"] or rows + len(op["rows"]) > MAX_BATCH_ROWS:
+                break
+            batch.append(op)
+            rows += len(op["rows"])
+        return batch
+
+    def _execute(self, batch):
+        op = batch[0]
+        if op["op"] == "append":
+            rows = [r for o in batch for r in o["rows"]]
+            if any(o.get("replay") for o in batch):
+                existing = self.backend.existing_keys(op["sheet"], [r[0] for r in rows])
+                if existing:
+                    METRICS.incr("queue.replay_skipped", len(existing))
+                    rows = [r for r in rows if str(r[0]) not in existing]
+            self.backend.append_rows(op["sheet"], rows)
+            return len(rows)
+        if op["op"] == "update":
+            return self.backend.update_row(op["sheet"], op["key"], op["values"])
+        if op["op"] == "delete_row":
+            return self.backend.delete_row(op["sheet"], op["value"], col=op.get("col", 1))
+        if op["op"] == "delete_where":
+            return self.backend.delete_where(op["sheet"], op["column"], op["value"])
+        if op["op"] == "archive":
+            return archive_trip(self.backend, op["trip_id"], op["partition"], op["archived_at"])
+        if op["op"] == "restore":
+            return restore_trip(self.backend, op["trip_id"], op["partition"])
+        raise StorageError(f"未知の操作: {op['op']}")
+
+    def _run(self):
+        attempt = 0
+        while True:
+            with self.cond:
+                while not self.ops:
+                    self.cond.wait()
+                first_seen = self.ops[0]["submitted_at"]
+            # 連続入力が届くまで少し待ってからまとめて送る
+            wait = BATCH_WINDOW - (time.time() - first_seen)
+            if wait > 0:
+                time.sleep(wait)
+            with self.cond:
+                batch = self._next_batch()
+            error = None
+            try:
+                with METRICS.timer(f"queue.{batch[0]['op']}"):
+                    result = self._execute(batch)
+            except Exception as e:
+                if is_transient(e):
+                    # QuotaClient の再試行でも失敗した一時的エラーはキューに残して後で再送する
+                    METRICS.incr("queue.requeued")
+                    with self.cond:
+                        for op in batch:
+                            op["replay"] = True
+                    attempt += 1
+                    time.sleep(random.uniform(0, min(RETRY_MAX, RETRY_BASE * 2 ** attempt)))
+                    continue
+                # 400 系・ID 不在など再送しても成功しない操作は退避して後続を止めない
+                result, error = None, e
+                with self.cond:
+                    self.failed.extend(dict(op, error=str(e)) for op in batch)
+            attempt = 0
+            self._complete(batch, result, error)
+
+    def _complete(self, batch, result, error):
+        # ここでの例外でワーカースレッドが止まると以降の書き込みがすべて滞るため、記録して続行する
+        done = {op["id"] for op in batch}
+        with self.cond:
+            self.ops = [op for op in self.ops if op["id"] not in done]
+            try:
+                if not self.ops or self.done_logged + len(done) > COMPACT_AFTER:
+                    self._compact()
+                else:
+                    self._append([{"done": sorted(done)}])
+                    self.done_logged += len(done)
+            except Exception:
+                log.exception("書き込みキューの保存に失敗しました")
+            self.cond.notify_all()
+        if self.on_applied:
+            for op in batch:
+                try:
+                    self.on_applied(op, result, error)
+                except Exception:
+                    log.exception("書き込み完了後の処理に失敗しました: %s", op.get("op"))